@@ -0,0 +1,249 @@
+import asyncio
+import subprocess
+import time
+import db
+import store
+
+APPLY_DELAY = 0.5
+
+_pending_blocks = {}
+_apply_task = None
+
+async def run_command(*args, input=None):
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE if input is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate(input)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+    return stdout.decode('utf-8')
+
+async def get_wg_snapshot(fresh=False):
+    peers = None if fresh else db.get_cached_wg_snapshot()
+    if peers is not None:
+        return peers
+
+    WG_CMD = await asyncio.to_thread(db.get_wg_cmd)
+    interfaces = (await run_command(WG_CMD, 'show', 'interfaces')).split()
+    outputs = await asyncio.gather(
+        *(run_command(WG_CMD, 'show', interface, 'dump') for interface in interfaces)
+    )
+
+    peers = {}
+    for interface, output in zip(interfaces, outputs):
+        peers.update(db.parse_wg_dump(interface, output))
+
+    db.set_wg_snapshot(peers)
+    return peers
+
+async def get_config_index():
+    return await asyncio.to_thread(db.get_config_index)
+
+async def set_peers_blocked(names, blocked):
+    return await asyncio.to_thread(db.set_peers_blocked, names, blocked)
+
+async def get_client_list():
+    return await asyncio.to_thread(db.get_client_list)
+
+async def get_all_clients_transfer():
+    try:
+        index, peers = await asyncio.gather(get_config_index(), get_wg_snapshot())
+    except subprocess.CalledProcessError:
+        return []
+    return db.build_clients_transfer(peers, index.keys)
+
+async def get_peer_counters():
+    taken_at = time.time()
+    index, peers = await asyncio.gather(get_config_index(), get_wg_snapshot(fresh=True))
+    return db.build_peer_counters(peers, index.keys), taken_at
+
+async def get_active_list():
+    try:
+        index, peers = await asyncio.gather(get_config_index(), get_wg_snapshot())
+    except subprocess.CalledProcessError as e:
+        print(f"Ошибка при получении активных клиентов: {e}")
+        return []
+    return await asyncio.to_thread(db.build_active_list, peers, index.keys)
+
+async def root_add(id_user, ipv6=False):
+    if not await asyncio.to_thread(db.root_add, id_user, ipv6):
+        return False
+    await asyncio.to_thread(store.add_client, id_user, int(time.time()))
+    return True
+
+async def root_add_many(names, ipv6=False):
+    clients, error = await asyncio.to_thread(db.root_add_many, names, ipv6)
+    if clients:
+        await asyncio.to_thread(store.add_clients, [name for name, _ in clients], int(time.time()))
+    return clients, error
+
+async def rerender_clients(progress=None):
+    return await asyncio.to_thread(db.rerender_clients, progress)
+
+async def deactive_user_db(id_user):
+    return await asyncio.to_thread(db.deactive_user_db, id_user)
+
+async def remove_peer(public_key):
+    WG_CMD = await asyncio.to_thread(db.get_wg_cmd)
+    interface_name = await asyncio.to_thread(db.get_interface_name)
+    await run_command(WG_CMD, 'set', interface_name, 'peer', public_key, 'remove')
+    db.invalidate_wg_snapshot()
+
+async def set_peer(public_key, preshared_key, allowed_ips):
+    WG_CMD = await asyncio.to_thread(db.get_wg_cmd)
+    interface_name = await asyncio.to_thread(db.get_interface_name)
+    cmd = [WG_CMD, 'set', interface_name, 'peer', public_key]
+    if preshared_key:
+        cmd += ['preshared-key', '/dev/stdin']
+    cmd += ['allowed-ips', allowed_ips.replace(' ', '')]
+    await run_command(*cmd, input=preshared_key.encode('ascii') if preshared_key else None)
+    db.invalidate_wg_snapshot()
+
+async def remove_peers(public_keys):
+    WG_CMD = await asyncio.to_thread(db.get_wg_cmd)
+    interface_name = await asyncio.to_thread(db.get_interface_name)
+    cmd = [WG_CMD, 'set', interface_name]
+    for public_key in public_keys:
+        cmd += ['peer', public_key, 'remove']
+    await run_command(*cmd)
+    db.invalidate_wg_snapshot()
+
+async def add_peers(peers):
+    WG_CMD = await asyncio.to_thread(db.get_wg_cmd)
+    interface_name = await asyncio.to_thread(db.get_interface_name)
+    blocks = []
+    for peer in peers:
+        lines = ['[Peer]', f'PublicKey = {peer.public_key}']
+        if peer.preshared_key:
+            lines.append(f'PresharedKey = {peer.preshared_key}')
+        lines.append(f'AllowedIPs = {peer.allowed_ips}')
+        blocks.append('\n'.join(lines))
+    await run_command(WG_CMD, 'addconf', interface_name, '/dev/stdin', input='\n\n'.join(blocks).encode('utf-8'))
+    db.invalidate_wg_snapshot()
+
+async def set_peer_blocked(name, blocked):
+    global _apply_task
+    future = asyncio.get_running_loop().create_future()
+    state, futures = _pending_blocks.get(name, (blocked, []))
+    if state != blocked:
+        _resolve(futures, False)
+        futures = []
+    futures.append(future)
+    _pending_blocks[name] = (blocked, futures)
+    if _apply_task is None or _apply_task.done():
+        _apply_task = asyncio.create_task(_run_apply_queue())
+    return await future
+
+def _resolve(futures, result):
+    for future in futures:
+        if not future.done():
+            future.set_result(result)
+
+async def _apply_blocks(blocks, changes):
+    sync_futures = []
+    for blocked in (True, False):
+        names = [name for name, (state, _) in blocks.items() if state == blocked]
+        if not names:
+            continue
+        try:
+            peers = (await set_peers_blocked(names, blocked)).peers
+        except Exception as e:
+            print(f"Ошибка при изменении конфигурации WireGuard: {e}")
+            peers = {}
+        for name in names:
+            futures = blocks[name][1]
+            peer = peers.get(name)
+            if not peer or peer.blocked != blocked:
+                _resolve(futures, False)
+            elif not peer.public_key:
+                sync_futures += futures
+            else:
+                _, pending = changes.get(peer.public_key, (None, []))
+                changes[peer.public_key] = (None if blocked else peer, pending + futures)
+    if sync_futures:
+        try:
+            await sync_interface()
+            _resolve(sync_futures, True)
+        except (subprocess.CalledProcessError, OSError):
+            _resolve(sync_futures, False)
+
+async def _run_apply_queue():
+    global _pending_blocks
+    while _pending_blocks:
+        await asyncio.sleep(APPLY_DELAY)
+        blocks, _pending_blocks = _pending_blocks, {}
+        changes = {}
+        try:
+            await _apply_blocks(blocks, changes)
+            results = {}
+            if changes:
+                results = await _apply_changes({key: peer for key, (peer, _) in changes.items()})
+        except Exception as e:
+            print(f"Ошибка при применении изменений WireGuard: {e}")
+            results = {}
+        for public_key, (_, futures) in changes.items():
+            _resolve(futures, results.get(public_key, False))
+        for _, futures in blocks.values():
+            _resolve(futures, False)
+
+async def _apply_changes(changes):
+    removed = [key for key, peer in changes.items() if peer is None]
+    added = [peer for peer in changes.values() if peer is not None]
+    results = {}
+    failed = []
+
+    if removed:
+        try:
+            await remove_peers(removed)
+            results.update(dict.fromkeys(removed, True))
+        except (subprocess.CalledProcessError, OSError):
+            failed += removed
+    if added:
+        try:
+            await add_peers(added)
+            results.update(dict.fromkeys((peer.public_key for peer in added), True))
+        except (subprocess.CalledProcessError, OSError):
+            failed += [peer.public_key for peer in added]
+
+    unresolved = []
+    for public_key in failed:
+        peer = changes[public_key]
+        try:
+            if peer is None:
+                await remove_peer(public_key)
+            else:
+                await set_peer(public_key, peer.preshared_key, peer.allowed_ips)
+            results[public_key] = True
+        except (subprocess.CalledProcessError, OSError):
+            unresolved.append(public_key)
+
+    if unresolved:
+        try:
+            await sync_interface()
+            synced = True
+        except (subprocess.CalledProcessError, OSError):
+            synced = False
+        results.update(dict.fromkeys(unresolved, synced))
+    return results
+
+async def sync_interface():
+    WG_CMD = await asyncio.to_thread(db.get_wg_cmd)
+    interface_name = await asyncio.to_thread(db.get_interface_name)
+    stripped = await run_command(f'{WG_CMD}-quick', 'strip', interface_name)
+    await run_command(WG_CMD, 'syncconf', interface_name, '/dev/stdin', input=stripped.encode('utf-8'))
+    db.invalidate_wg_snapshot()
+
+async def set_user_expiration(username, expiration):
+    await asyncio.to_thread(db.set_user_expiration, username, expiration)
+
+async def set_users_expiration(usernames, expiration):
+    await asyncio.to_thread(db.set_users_expiration, usernames, expiration)
+
+async def get_users_with_expiration():
+    return await asyncio.to_thread(db.get_users_with_expiration)
+
+async def get_user_expiration(username):
+    return await asyncio.to_thread(db.get_user_expiration, username)
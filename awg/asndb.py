@@ -0,0 +1,166 @@
+import os
+import sys
+import csv
+import gzip
+import mmap
+import struct
+import bisect
+import argparse
+import ipaddress
+
+MAGIC = b'AWGASN1\0'
+HEADER = struct.Struct('<8sIII')
+INDEX = struct.Struct('<I')
+
+class _Keys:
+    def __init__(self, buffer, offset, width, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.width
+        return self.buffer[start:start + self.width]
+
+class _Section:
+    def __init__(self, buffer, offset, width, count):
+        self.count = count
+        self.starts = _Keys(buffer, offset, width, count)
+        offset += width * count
+        self.ends = _Keys(buffer, offset, width, count)
+        offset += width * count
+        self.names = _Keys(buffer, offset, INDEX.size, count)
+        self.size = (width * 2 + INDEX.size) * count
+
+    def find(self, key):
+        i = bisect.bisect_right(self.starts, key) - 1
+        if i < 0 or key > self.ends[i]:
+            return None
+        return INDEX.unpack(self.names[i])[0]
+
+class AsnDatabase:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, v4_count, v6_count, names_count = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            self.buffer.close()
+            raise ValueError(f"{path} is not a compiled ASN database")
+        offset = HEADER.size
+        self.v4 = _Section(self.buffer, offset, 4, v4_count)
+        offset += self.v4.size
+        self.v6 = _Section(self.buffer, offset, 16, v6_count)
+        offset += self.v6.size
+        self.name_offsets = _Keys(self.buffer, offset, INDEX.size, names_count + 1)
+        self.names_start = offset + INDEX.size * (names_count + 1)
+
+    def __len__(self):
+        return self.v4.count + self.v6.count
+
+    def name(self, index):
+        start = INDEX.unpack(self.name_offsets[index])[0]
+        end = INDEX.unpack(self.name_offsets[index + 1])[0]
+        return self.buffer[self.names_start + start:self.names_start + end].decode('utf-8')
+
+    def lookup(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        section = self.v4 if address.version == 4 else self.v6
+        index = section.find(address.packed)
+        return self.name(index) if index is not None else None
+
+    def close(self):
+        self.buffer.close()
+
+def _open_source(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+def read_ranges(path):
+    with _open_source(path) as f:
+        sample = f.readline()
+        delimiter = '\t' if '\t' in sample else ','
+        f.seek(0)
+        for row in csv.reader(f, delimiter=delimiter):
+            if len(row) < 3 or row[0].startswith('#'):
+                continue
+            try:
+                start = ipaddress.ip_address(row[0].strip())
+                end = ipaddress.ip_address(row[1].strip())
+                asn = int(row[2].strip().upper().lstrip('AS') or 0)
+            except ValueError:
+                continue
+            if not asn or start.version != end.version:
+                continue
+            description = row[-1].strip() if len(row) > 3 else ''
+            yield start, end, f"{description} (AS{asn})" if description else f"AS{asn}"
+
+def compile_database(source, target):
+    sections = {4: [], 6: []}
+    names = {}
+    for start, end, name in read_ranges(source):
+        index = names.setdefault(name, len(names))
+        sections[start.version].append((start.packed, end.packed, index))
+
+    blob = bytearray()
+    name_offsets = [0]
+    for name in names:
+        blob += name.encode('utf-8')
+        name_offsets.append(len(blob))
+
+    temp_path = f'{target}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(sections[4]), len(sections[6]), len(names)))
+        for version in (4, 6):
+            rows = sorted(sections[version])
+            f.write(b''.join(start for start, _, _ in rows))
+            f.write(b''.join(end for _, end, _ in rows))
+            f.write(b''.join(INDEX.pack(index) for _, _, index in rows))
+        f.write(b''.join(INDEX.pack(offset) for offset in name_offsets))
+        f.write(blob)
+    os.replace(temp_path, target)
+    return target
+
+def is_compiled(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def open_database(path):
+    if is_compiled(path):
+        return AsnDatabase(path)
+    compiled_path = f'{path}.bin'
+    if not os.path.exists(compiled_path) or os.path.getmtime(compiled_path) < os.path.getmtime(path):
+        compile_database(path, compiled_path)
+    return AsnDatabase(compiled_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile an IP range to ASN dataset (ip2asn TSV/CSV) and query it.')
+    parser.add_argument('source', help='Source TSV/CSV file (optionally .gz) or compiled database.')
+    parser.add_argument('-o', '--output', help='Compiled database file. Defaults to <source>.bin.')
+    parser.add_argument('-q', '--query', nargs='*', help='IP addresses to look up.')
+
+    args = parser.parse_args()
+
+    try:
+        if args.output:
+            database = AsnDatabase(compile_database(args.source, args.output))
+        else:
+            database = open_database(args.source)
+    except (OSError, ValueError) as e:
+        print(f'Error: {e}', file=sys.stderr)
+        sys.exit(1)
+
+    print(f'{database.path}: {len(database)} ranges')
+    for ip in args.query or []:
+        print(f'{ip}\t{database.lookup(ip) or "-"}')
+
+if __name__ == '__main__':
+    main()
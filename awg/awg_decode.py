@@ -0,0 +1,227 @@
+import os
+import sys
+import glob
+import json
+import struct
+import zlib
+import base64
+import argparse
+import socket
+import ipaddress
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def qCompress(data, level=-1):
+    compressed = zlib.compress(data, level)
+    header = struct.pack('>I', len(data))
+    return header + compressed
+
+def qUncompress(data):
+    if len(data) < 4:
+        return b''
+    uncompressed_size = struct.unpack('>I', data[:4])[0]
+    compressed_data = data[4:]
+    try:
+        uncompressed_data = zlib.decompress(compressed_data)
+    except zlib.error:
+        return b''
+    if len(uncompressed_data) != uncompressed_size:
+        return b''
+    return uncompressed_data
+
+def base64url_encode(data):
+    encoded = base64.urlsafe_b64encode(data)
+    return encoded.rstrip(b'=')
+
+def base64url_decode(data):
+    padding_needed = (4 - len(data) % 4) % 4
+    data += b'=' * padding_needed
+    return base64.urlsafe_b64decode(data)
+
+def is_ip_address(address):
+    try:
+        ipaddress.ip_address(address)
+        return True
+    except ValueError:
+        return False
+
+def resolve_dns_to_ip(dns_name):
+    try:
+        ip_address = socket.gethostbyname(dns_name)
+        return ip_address
+    except socket.gaierror:
+        return None
+
+def make_resolver():
+    resolved = {}
+
+    def resolve(dns_name):
+        ip_address = resolved.get(dns_name)
+        if ip_address is None:
+            ip_address = resolve_dns_to_ip(dns_name)
+            if ip_address is not None:
+                resolved[dns_name] = ip_address
+        return ip_address
+    return resolve
+
+def process_conf_data(data, resolve=resolve_dns_to_ip):
+    def replace_endpoint(match):
+        full_line = match.group(0)
+        prefix = match.group(1)
+        address = match.group(2)
+        port = match.group(3)
+        suffix = match.group(4)
+        if not is_ip_address(address):
+            resolved_ip = resolve(address)
+            if resolved_ip:
+                print(f"Resolved DNS '{address}' to IP '{resolved_ip}'", file=sys.stderr)
+                return f"{prefix}{resolved_ip}:{port}{suffix}"
+            else:
+                raise ValueError(f"Could not resolve DNS name '{address}'")
+        else:
+            return full_line
+    pattern = r'^(.*Endpoint\s*=\s*)([^\s:]+)(?::(\d+))(.*)$'
+    return re.sub(pattern, replace_endpoint, data, flags=re.MULTILINE)
+
+def encode(data):
+    data_bytes = data.encode('utf-8')
+    compressed = qCompress(data_bytes, level=8)
+    base64_encoded = base64url_encode(compressed)
+    s = 'vpn://' + base64_encoded.decode('ascii')
+    return s
+
+def decode(s):
+    data = s.replace('vpn://', '')
+    data_bytes = data.encode('ascii')
+    compressed = base64url_decode(data_bytes)
+    uncompressed = qUncompress(compressed)
+    if uncompressed:
+        result = uncompressed
+    else:
+        result = compressed
+    return result.decode('utf-8')
+
+def encode_file(path, resolve=resolve_dns_to_ip):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = f.read()
+    return encode(process_conf_data(data, resolve))
+
+def iter_batch_inputs(source, encode_mode):
+    if source == '-':
+        for line in sys.stdin:
+            line = line.strip()
+            if line:
+                yield line
+        return
+    if os.path.isdir(source):
+        pattern = os.path.join(source, '**', '*.conf' if encode_mode else '*')
+    else:
+        pattern = source
+    for path in sorted(glob.iglob(pattern, recursive=True)):
+        if os.path.isfile(path):
+            yield path
+
+def process_batch_item(item, encode_mode, resolve=resolve_dns_to_ip):
+    try:
+        if encode_mode:
+            return {'input': item, 'output': encode_file(item, resolve)}
+        if item.startswith('vpn://'):
+            vpn_string = item
+        else:
+            with open(item, 'r', encoding='utf-8') as f:
+                vpn_string = f.read().strip()
+        decoded = decode(vpn_string)
+        if not decoded:
+            raise ValueError('Invalid vpn:// string')
+        return {'input': item, 'output': decoded}
+    except (OSError, ValueError) as e:
+        return {'input': item, 'error': str(e)}
+
+def run_batch(items, encode_mode, jobs):
+    resolve = make_resolver()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(process_batch_item, item, encode_mode, resolve))
+            if len(pending) >= jobs * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def main_batch(args):
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    failed = 0
+    try:
+        for result in run_batch(iter_batch_inputs(args.input, args.encode), args.encode, args.jobs):
+            if 'error' in result:
+                failed += 1
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    finally:
+        if args.output:
+            output.close()
+    if failed:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode and decode VPN configuration files to/from vpn:// format.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-e', '--encode', action='store_true', help='Encode a .conf file to vpn:// format.')
+    group.add_argument('-d', '--decode', action='store_true', help='Decode a vpn:// string to configuration data.')
+    parser.add_argument('input', help='Input file for encoding or vpn:// string for decoding. With --batch: a directory, a glob or - for newline-delimited stdin.')
+    parser.add_argument('-o', '--output', help='Output file. If not specified, output will be printed to console.')
+    parser.add_argument('-b', '--batch', action='store_true', help='Process many inputs and write JSON lines with an output or error per item.')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of workers in batch mode.')
+
+    args = parser.parse_args()
+
+    if args.batch:
+        main_batch(args)
+        return
+
+    if args.encode:
+        try:
+            with open(args.input, 'r', encoding='utf-8') as f:
+                data = f.read()
+        except FileNotFoundError:
+            print(f'Error: File {args.input} not found.')
+            sys.exit(1)
+        except Exception as e:
+            print(f'Error reading file {args.input}: {e}')
+            sys.exit(1)
+
+        try:
+            processed_data = process_conf_data(data)
+        except ValueError as e:
+            print(f'Error: {e}', file=sys.stderr)
+            sys.exit(1)
+
+        encoded_string = encode(processed_data)
+
+        if args.output:
+            try:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    f.write(encoded_string)
+                print(f'Encoded vpn:// string written to {args.output}')
+            except Exception as e:
+                print(f'Error writing to file {args.output}: {e}')
+        else:
+            print(encoded_string)
+
+    elif args.decode:
+        vpn_string = args.input
+
+        decoded_data = decode(vpn_string)
+
+        if args.output:
+            try:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    f.write(decoded_data)
+                print(f'Decoded configuration data written to {args.output}')
+            except Exception as e:
+                print(f'Error writing to file {args.output}: {e}')
+        else:
+            print(decoded_data)
+
+if __name__ == '__main__':
+    main()
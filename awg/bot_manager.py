@@ -1,20 +1,31 @@
 import db
-import aiohttp
+import aiodb
+import store
+import awg_decode
+import qr
+import isp
+import asndb
+import ledger
+import timeseries
+import enforcement
+import provision
 import asyncio
-import aiofiles
 import os
 import re
 import tempfile
-import json
+import subprocess
+import time
 import pytz
 import ipaddress
 import zipfile
 import humanize
+import hashlib
 import logging
 from aiogram import Bot, types
 from aiogram.dispatcher import Dispatcher
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.utils import executor
+from aiogram.utils.exceptions import TelegramAPIError
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -46,242 +57,216 @@ dp.middleware.setup(AdminMessageDeletionMiddleware())
 
 main_menu_markup = InlineKeyboardMarkup(row_width=1).add(
     InlineKeyboardButton("Добавить пользователя", callback_data="add_user"),
+    InlineKeyboardButton("Массовое добавление", callback_data="bulk_add"),
     InlineKeyboardButton("Получить файлы пользователя", callback_data="get_config"),
     InlineKeyboardButton("Список клиентов", callback_data="list_users"),
     InlineKeyboardButton("Создать бекап", callback_data="create_backup"),
+    InlineKeyboardButton("Обновить QR-коды", callback_data="regen_qr"),
+    InlineKeyboardButton("Обновить конфигурации клиентов", callback_data="rerender_configs"),
     InlineKeyboardButton("Перезагрузить протокол", callback_data="reload_config")
 )
 
 user_main_messages = {}
-isp_cache = {}
-ISP_CACHE_FILE = 'files/isp_cache.json'
+vpn_key_cache = {}
+isp_lookup = isp.IspLookup()
+asn_database = None
 CACHE_TTL = timedelta(hours=24)
-TRAFFIC_LIMITS_FILE = 'files/traffic_limits.json'
+isp_cache = isp.IspCache(
+    max_size=int(setting.get('isp_cache_size', isp.CACHE_SIZE)),
+    ttl=CACHE_TTL.total_seconds()
+)
 previous_traffic = {}
+ENDPOINTS_FLUSH_INTERVAL = 60
+CONNECTIONS_RETENTION_DAYS = int(setting.get('connections_retention_days', 90))
+CONNECTIONS_MAX_PER_CLIENT = int(setting.get('connections_max_per_client', 100))
 
-def load_traffic_limits():
-    if os.path.exists(TRAFFIC_LIMITS_FILE):
-        with open(TRAFFIC_LIMITS_FILE, 'r') as f:
-            limits = json.load(f)
-            for username, data in limits.items():
-                if 'limit' in data and isinstance(data['limit'], str):
-                    data['limit'] = int(data['limit'])
-                if 'used' in data and isinstance(data['used'], str):
-                    data['used'] = int(data['used'])
-                if 'prev_total' in data and isinstance(data['prev_total'], str):
-                    data['prev_total'] = int(data['prev_total'])
-            return limits
-    else:
-        return {}
+traffic_ledger = ledger.TrafficLedger()
+traffic_series = timeseries.TrafficSeries()
+traffic_enforcer = enforcement.EnforcementScheduler(
+    int(setting.get('traffic_poll_min', enforcement.MIN_INTERVAL)),
+    int(setting.get('traffic_poll_max', enforcement.MAX_INTERVAL)),
+    int(setting.get('traffic_poll_idle', enforcement.IDLE_INTERVAL))
+)
+traffic_poll_lock = asyncio.Lock()
+traffic_refresh = None
+LEDGER_CHECKPOINT_INTERVAL = 300
+SPARKLINE = '▁▂▃▄▅▆▇█'
+
+async def commit_traffic():
+    await asyncio.to_thread(traffic_ledger.commit)
+
+async def checkpoint_traffic():
+    await asyncio.to_thread(traffic_ledger.checkpoint)
+    rows = traffic_series.take_dirty()
+    if rows:
+        await asyncio.to_thread(store.save_traffic_series, rows)
 
-def save_traffic_limits(limits):
-    os.makedirs(os.path.dirname(TRAFFIC_LIMITS_FILE), exist_ok=True)
-    with open(TRAFFIC_LIMITS_FILE, 'w') as f:
-        json.dump(limits, f)
+async def load_traffic_series():
+    rows = await asyncio.to_thread(store.get_traffic_series, traffic_series.oldest_buckets(time.time()))
+    traffic_series.load(rows)
+
+async def compact_traffic_series():
+    await asyncio.to_thread(store.compact_traffic_series, traffic_series.oldest_buckets(time.time()))
 
 async def load_isp_cache():
-    global isp_cache
-    if os.path.exists(ISP_CACHE_FILE):
-        async with aiofiles.open(ISP_CACHE_FILE, 'r') as f:
-            try:
-                isp_cache = json.loads(await f.read())
-                for ip in list(isp_cache.keys()):
-                    isp_cache[ip]['timestamp'] = datetime.fromisoformat(isp_cache[ip]['timestamp'])
-            except:
-                isp_cache = {}
+    try:
+        cached = await asyncio.to_thread(store.get_isp_cache, isp_cache.max_size)
+    except:
+        return
+    for ip, isp_name, timestamp in cached:
+        try:
+            isp_cache.put(ip, isp_name, datetime.fromisoformat(timestamp).timestamp(), persist=False)
+        except ValueError:
+            continue
 
-async def save_isp_cache():
-    async with aiofiles.open(ISP_CACHE_FILE, 'w') as f:
-        cache_to_save = {ip: {'isp': data['isp'], 'timestamp': data['timestamp'].isoformat()} for ip, data in isp_cache.items()}
-        await f.write(json.dumps(cache_to_save))
+def load_asn_database():
+    global asn_database
+    path = setting.get('isp_db')
+    if not path:
+        return
+    try:
+        asn_database = asndb.open_database(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось загрузить базу ISP {path}: {e}")
+
+def lookup_offline_isp(ip):
+    if asn_database is None:
+        return None
+    return asn_database.lookup(ip)
+
+async def flush_isp_cache():
+    rows = isp_cache.take_dirty()
+    if rows:
+        await asyncio.to_thread(
+            store.save_isps,
+            [(ip, isp_name, datetime.fromtimestamp(timestamp, pytz.UTC).isoformat()) for ip, isp_name, timestamp in rows]
+        )
 
 async def get_isp_info(ip: str) -> str:
-    now = datetime.now(pytz.UTC)
-    if ip in isp_cache and now - isp_cache[ip]['timestamp'] < CACHE_TTL:
-        return isp_cache[ip]['isp']
+    found, isp_name = isp_cache.get(ip)
+    if found:
+        return isp_name or "Unknown ISP"
     try:
         ip_obj = ipaddress.ip_address(ip)
         if ip_obj.is_private:
             return "Private Range"
     except:
         return "Invalid IP"
-    url = f"http://ip-api.com/json/{ip}?fields=status,message,isp"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data.get('status') == 'success':
-                        isp = data.get('isp', 'Unknown ISP')
-                        isp_cache[ip] = {'isp': isp, 'timestamp': now}
-                        await save_isp_cache()
-                        return isp
-    except:
-        pass
-    return "Unknown ISP"
+    isp_name = lookup_offline_isp(ip)
+    if isp_name:
+        return isp_name
+    isp_name = await isp_lookup.lookup(ip)
+    isp_cache.put(ip, isp_name)
+    return isp_name or "Unknown ISP"
 
 async def cleanup_isp_cache():
     now = datetime.now(pytz.UTC)
-    for ip in list(isp_cache.keys()):
-        if now - isp_cache[ip]['timestamp'] >= CACHE_TTL:
-            del isp_cache[ip]
-    await save_isp_cache()
-
-async def cleanup_connection_data(username: str):
-    file_path = os.path.join('files', 'connections', f'{username}_ip.json')
-    if os.path.exists(file_path):
-        async with aiofiles.open(file_path, 'r') as f:
-            try:
-                data = json.loads(await f.read())
-            except:
-                data = {}
-        sorted_ips = sorted(data.items(), key=lambda x: datetime.strptime(x[1], '%d.%m.%Y %H:%M'), reverse=True)
-        limited_ips = dict(sorted_ips[:100])
-        async with aiofiles.open(file_path, 'w') as f:
-            await f.write(json.dumps(limited_ips))
+    isp_cache.purge(now.timestamp())
+    await asyncio.to_thread(store.delete_isp_older_than, (now - CACHE_TTL).isoformat())
+
+async def compact_connection_history():
+    min_last_seen = int((datetime.now(pytz.UTC) - timedelta(days=CONNECTIONS_RETENTION_DAYS)).timestamp())
+    removed = await asyncio.to_thread(store.compact_connections, min_last_seen, CONNECTIONS_MAX_PER_CLIENT)
+    if removed:
+        logger.info(f"Удалено устаревших записей о подключениях: {removed}")
 
 async def load_isp_cache_task():
+    await asyncio.to_thread(load_asn_database)
     await load_isp_cache()
     scheduler.add_job(cleanup_isp_cache, 'interval', hours=1)
+    scheduler.add_job(flush_isp_cache, 'interval', seconds=ENDPOINTS_FLUSH_INTERVAL)
 
-def get_ipv6_subnet():
-    try:
-        with open(WG_CONFIG_FILE, 'r') as f:
-            in_interface = False
-            for line in f:
-                line = line.strip()
-                if line.startswith('[Interface]'):
-                    in_interface = True
-                    continue
-                if in_interface:
-                    if line.startswith('Address'):
-                        addresses = line.split('=')[1].strip().split(',')
-                        for addr in addresses:
-                            addr = addr.strip()
-                            if ':' in addr:
-                                parts = addr.split('/')
-                                if len(parts) == 2:
-                                    ip, mask = parts
-                                    prefix = re.sub(r'::[0-9a-fA-F]+$', '::', ip)
-                                    return f"{prefix}/64"
-                        return None
-                    elif line.startswith('['):
-                        break
-    except:
-        return None
+async def get_ipv6_subnet():
+    addresses = (await aiodb.get_config_index()).interface.get('Address', '')
+    for addr in addresses.split(','):
+        addr = addr.strip()
+        if ':' in addr:
+            parts = addr.split('/')
+            if len(parts) == 2:
+                ip, mask = parts
+                prefix = re.sub(r'::[0-9a-fA-F]+$', '::', ip)
+                return f"{prefix}/64"
+    return None
 
-def is_user_blocked(username):
-    try:
-        with open(WG_CONFIG_FILE, 'r') as f:
-            config = f.read()
-        pattern = rf'(# BEGIN_PEER {username}\n)(.*?\n)(# END_PEER {username})'
-        match = re.search(pattern, config, re.DOTALL)
-        if match:
-            peer_block = match.group(2)
-            lines = peer_block.strip().split('\n')
-            if all(line.strip().startswith('#') or line.strip() == '' for line in lines):
-                return True
-            else:
-                return False
-        else:
-            return False
-    except:
-        return False
+async def is_user_blocked(username):
+    peer = (await aiodb.get_config_index()).peers.get(username)
+    return bool(peer and peer.blocked)
+
+async def set_users_blocked(usernames, blocked):
+    outcomes = await asyncio.gather(
+        *(aiodb.set_peer_blocked(username, blocked) for username in usernames),
+        return_exceptions=True
+    )
+    results = {}
+    for username, outcome in zip(usernames, outcomes):
+        results[username] = outcome is True
+        if results[username] and blocked:
+            traffic_ledger.mark_reset(username)
+    return results
+
+async def block_users(usernames):
+    return await set_users_blocked(usernames, True)
 
 async def block_user(username):
-    try:
-        async with aiofiles.open(WG_CONFIG_FILE, 'r') as f:
-            config = await f.read()
-        pattern = rf'(# BEGIN_PEER {username}\n)(.*?)(# END_PEER {username})'
-        match = re.search(pattern, config, re.DOTALL)
-        if match:
-            start = match.group(1)
-            peer_block = match.group(2)
-            end = match.group(3)
-            lines = peer_block.splitlines(keepends=True)
-            commented_lines = [f'# {line}' if not line.strip().startswith('#') else line for line in lines]
-            commented_block = ''.join(commented_lines)
-            new_block = f'{start}{commented_block}{end}'
-            config = config.replace(match.group(0), new_block)
-        else:
-            return False
-        async with aiofiles.open(WG_CONFIG_FILE, 'w') as f:
-            await f.write(config)
-        success = await restart_wireguard()
-        if not success:
-            return False
-        return True
-    except:
-        return False
+    return (await block_users([username]))[username]
 
 async def unblock_user(username):
-    try:
-        async with aiofiles.open(WG_CONFIG_FILE, 'r') as f:
-            config = await f.read()
-        pattern = rf'(# BEGIN_PEER {username}\n)(.*?)(# END_PEER {username})'
-        match = re.search(pattern, config, re.DOTALL)
-        if match:
-            start = match.group(1)
-            peer_block = match.group(2)
-            end = match.group(3)
-            lines = peer_block.splitlines(keepends=True)
-            uncommented_lines = [line.lstrip('# ').rstrip('\n') + '\n' for line in lines]
-            uncommented_block = ''.join(uncommented_lines)
-            new_block = f'{start}{uncommented_block}{end}'
-            config = config.replace(match.group(0), new_block)
-        else:
-            return False
-        async with aiofiles.open(WG_CONFIG_FILE, 'w') as f:
-            await f.write(config)
-        success = await restart_wireguard()
-        if not success:
-            return False
-        return True
-    except:
-        return False
+    return (await set_users_blocked([username], False))[username]
 
-async def restart_wireguard():
-    try:
-        interface_name = os.path.basename(WG_CONFIG_FILE).split('.')[0]
-        process_strip = await asyncio.create_subprocess_shell(
-            f'{WG_QUICK_CMD} strip {interface_name}',
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout_strip, stderr_strip = await process_strip.communicate()
-        if process_strip.returncode != 0:
-            return False
-        with tempfile.NamedTemporaryFile(delete=False) as temp_config:
-            temp_config.write(stdout_strip)
-            temp_config_path = temp_config.name
-        process_syncconf = await asyncio.create_subprocess_shell(
-            f'{WG_CMD} syncconf {interface_name} {temp_config_path}',
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout_syncconf, stderr_syncconf = await process_syncconf.communicate()
-        os.unlink(temp_config_path)
-        if process_syncconf.returncode != 0:
-            return False
-        return True
-    except:
-        return False
+async def reset_traffic_counters():
+    for username, *_ in list(traffic_ledger.items()):
+        traffic_ledger.mark_reset(username)
+    db.invalidate_wg_snapshot()
+    await commit_traffic()
 
 def create_zip(backup_filepath):
-    with zipfile.ZipFile(backup_filepath, 'w') as zipf:
-        for main_file in ['awg-decode.py', 'newclient.sh', 'removeclient.sh']:
-            if os.path.exists(main_file):
-                zipf.write(main_file, main_file)
-        for root, dirs, files in os.walk('files'):
-            for file in files:
-                filepath = os.path.join(root, file)
-                arcname = os.path.relpath(filepath, os.getcwd())
-                zipf.write(filepath, arcname)
-        for root, dirs, files in os.walk('users'):
-            for file in files:
-                filepath = os.path.join(root, file)
-                arcname = os.path.relpath(filepath, os.getcwd())
-                zipf.write(filepath, arcname)
+    traffic_ledger.checkpoint()
+    database_files = {store.DB_FILE, f'{store.DB_FILE}-wal', f'{store.DB_FILE}-shm'}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_path = os.path.join(temp_dir, 'bot.db')
+        store.backup(database_path)
+        with zipfile.ZipFile(backup_filepath, 'w') as zipf:
+            for main_file in ['awg-decode.py', 'awg_decode.py', 'newclient.sh', 'removeclient.sh']:
+                if os.path.exists(main_file):
+                    zipf.write(main_file, main_file)
+            zipf.write(database_path, store.DB_FILE)
+            for root, dirs, files in os.walk('files'):
+                for file in files:
+                    filepath = os.path.join(root, file)
+                    arcname = os.path.relpath(filepath, os.getcwd())
+                    if arcname in database_files:
+                        continue
+                    zipf.write(filepath, arcname)
+            for root, dirs, files in os.walk('users'):
+                for file in files:
+                    filepath = os.path.join(root, file)
+                    arcname = os.path.relpath(filepath, os.getcwd())
+                    zipf.write(filepath, arcname)
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def send_cached_file(kind: str, chat_id: int, path: str, **kwargs):
+    send = bot.send_photo if kind == 'photo' else bot.send_document
+    digest = await asyncio.to_thread(file_digest, path)
+    file_id = await asyncio.to_thread(store.get_file_id, path, digest)
+    if file_id:
+        try:
+            return await send(chat_id, file_id, **kwargs)
+        except TelegramAPIError:
+            pass
+    with open(path, 'rb') as f:
+        sent_message = await send(chat_id, f, **kwargs)
+    if kind == 'photo':
+        file_id = sent_message.photo[-1].file_id
+    else:
+        file_id = sent_message.document.file_id
+    await asyncio.to_thread(store.save_file_id, path, digest, file_id)
+    return sent_message
 
 async def delete_message_after_delay(chat_id: int, message_id: int, delay: int):
     await asyncio.sleep(delay)
@@ -290,6 +275,19 @@ async def delete_message_after_delay(chat_id: int, message_id: int, delay: int):
     except:
         pass
 
+def get_vpn_key_qr(username, vpn_key):
+    png_path = os.path.join('users', username, f'{username}_key.png')
+    try:
+        with open(png_path + '.key', 'r') as f:
+            if f.read() == vpn_key and os.path.exists(png_path):
+                return png_path
+    except OSError:
+        pass
+    qr.write_png(vpn_key, png_path)
+    with open(png_path + '.key', 'w') as f:
+        f.write(vpn_key)
+    return png_path
+
 def format_vpn_key(vpn_key, num_lines=8):
     line_length = len(vpn_key) // num_lines
     if len(vpn_key) % num_lines != 0:
@@ -310,6 +308,31 @@ async def help_command_handler(message: types.Message):
     else:
         await message.answer("У вас нет доступа к этому боту.")
 
+@dp.message_handler(commands=['stats'])
+async def stats_command_handler(message: types.Message):
+    if message.chat.id != admin:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+    stats = isp_cache.stats()
+    lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+    hit_rate = (stats['hits'] + stats['negative_hits']) / lookups * 100 if lookups else 0
+    gaps = await asyncio.to_thread(store.count_traffic_gaps, int(time.time()) - 86400)
+    enforcement_stats = traffic_enforcer.stats()
+    text = (
+        f"Сбросов счётчиков трафика за сутки: {gaps}\n\n"
+        "*Контроль лимитов:*\n"
+        f"Интервал опроса: {enforcement_stats['interval']:.1f} с (опросов: {enforcement_stats['polls']}, активных клиентов: {enforcement_stats['tracked']})\n"
+        f"Блокировок: {enforcement_stats['enforcements']}, задержка: средняя {enforcement_stats['lag_avg']:.1f} с, макс. {enforcement_stats['lag_max']:.1f} с\n"
+        f"Превышение лимита: среднее {humanize.naturalsize(enforcement_stats['overshoot_avg'], binary=True)}, макс. {humanize.naturalsize(enforcement_stats['overshoot_max'], binary=True)}\n\n"
+        "*Кеш ISP:*\n"
+        f"Записей: {stats['size']} из {stats['max_size']}\n"
+        f"Попадания: {stats['hits']} (отрицательные: {stats['negative_hits']}), промахи: {stats['misses']} ({hit_rate:.1f}% попаданий)\n"
+        f"Истекло: {stats['expired']}, вытеснено: {stats['evictions']}\n"
+        f"Записано в базу: {stats['writes']}, ожидает записи: {stats['dirty']}"
+    )
+    sent_message = await message.answer(text, parse_mode="Markdown", disable_notification=True)
+    asyncio.create_task(delete_message_after_delay(sent_message.chat.id, sent_message.message_id, delay=30))
+
 @dp.message_handler()
 async def handle_messages(message: types.Message):
     if message.chat.id != admin:
@@ -323,7 +346,7 @@ async def handle_messages(message: types.Message):
             return
         user_main_messages['client_name'] = user_name
         user_main_messages['waiting_for_user_name'] = False
-        ipv6_subnet = get_ipv6_subnet()
+        ipv6_subnet = await get_ipv6_subnet()
         if ipv6_subnet:
             connect_buttons = [
                 InlineKeyboardButton("С IPv6", callback_data=f'connect_{user_name}_ipv6'),
@@ -364,6 +387,43 @@ async def handle_messages(message: types.Message):
                 )
             else:
                 await message.answer("Ошибка: главное сообщение не найдено.")
+    elif user_main_messages.get('waiting_for_bulk_names'):
+        try:
+            names = provision.expand_names(message.text)
+        except provision.ProvisioningError as e:
+            sent_message = await message.reply(str(e))
+            asyncio.create_task(delete_message_after_delay(sent_message.chat.id, sent_message.message_id, delay=5))
+            return
+        if not names:
+            return
+        user_main_messages['waiting_for_bulk_names'] = False
+        user_main_messages['bulk_names'] = names
+        main_chat_id, main_message_id = user_main_messages.get(admin, (None, None))
+        if not main_chat_id or not main_message_id:
+            await message.answer("Ошибка: главное сообщение не найдено.")
+            return
+        if await get_ipv6_subnet():
+            connect_buttons = [
+                InlineKeyboardButton("С IPv6", callback_data="bulk_connect_ipv6"),
+                InlineKeyboardButton("Без IPv6", callback_data="bulk_connect_noipv6"),
+                InlineKeyboardButton("Домой", callback_data="home")
+            ]
+            await bot.edit_message_text(
+                chat_id=main_chat_id,
+                message_id=main_message_id,
+                text=f"Клиентов к добавлению: **{len(names)}**. Выберите тип подключения:",
+                parse_mode="Markdown",
+                reply_markup=InlineKeyboardMarkup(row_width=1).add(*connect_buttons)
+            )
+        else:
+            user_main_messages['ipv6'] = 'noipv6'
+            await bot.edit_message_text(
+                chat_id=main_chat_id,
+                message_id=main_message_id,
+                text=f"Клиентов к добавлению: **{len(names)}**. Выберите время действия конфигураций:",
+                parse_mode="Markdown",
+                reply_markup=bulk_duration_markup()
+            )
     else:
         sent_message = await message.reply("Неизвестная команда или действие.")
         asyncio.create_task(delete_message_after_delay(sent_message.chat.id, sent_message.message_id, delay=2))
@@ -384,6 +444,7 @@ async def prompt_for_user_name(callback_query: types.CallbackQuery):
             )
         )
         user_main_messages['waiting_for_user_name'] = True
+        user_main_messages['waiting_for_bulk_names'] = False
     else:
         await callback_query.answer("Ошибка: главное сообщение не найдено.", show_alert=True)
     await callback_query.answer()
@@ -496,31 +557,25 @@ async def set_traffic_limit(callback: types.CallbackQuery):
         traffic_limit = None
     else:
         traffic_limit = int(traffic_choice.replace('GB', '')) * 1024 * 1024 * 1024
-    clients_transfer = db.get_all_clients_transfer()
+    clients_transfer = await aiodb.get_all_clients_transfer()
     user_transfer = next((ct for ct in clients_transfer if ct['username'] == client_name), None)
     if user_transfer:
         total_bytes = user_transfer['received_bytes'] + user_transfer['sent_bytes']
     else:
         total_bytes = 0
-    traffic_limits = load_traffic_limits()
-    traffic_limits[client_name] = {
-        'limit': traffic_limit,
-        'used': 0,
-        'prev_total': total_bytes
-    }
-    save_traffic_limits(traffic_limits)
+    traffic_ledger.set(client_name, traffic_limit, 0, total_bytes)
+    await commit_traffic()
     if ipv6_flag == 'ipv6':
-        success = db.root_add(client_name, ipv6=True)
+        success = await aiodb.root_add(client_name, ipv6=True)
     else:
-        success = db.root_add(client_name, ipv6=False)
+        success = await aiodb.root_add(client_name, ipv6=False)
     if success:
         try:
             conf_path = os.path.join('users', client_name, f'{client_name}.conf')
             png_path = os.path.join('users', client_name, f'{client_name}.png')
             if os.path.exists(png_path):
-                with open(png_path, 'rb') as photo:
-                    sent_photo = await bot.send_photo(admin, photo, disable_notification=True)
-                    asyncio.create_task(delete_message_after_delay(admin, sent_photo.message_id, delay=15))
+                sent_photo = await send_cached_file('photo', admin, png_path, disable_notification=True)
+                asyncio.create_task(delete_message_after_delay(admin, sent_photo.message_id, delay=15))
             vpn_key = ""
             if os.path.exists(conf_path):
                 vpn_key = await generate_vpn_key(conf_path)
@@ -539,15 +594,15 @@ async def set_traffic_limit(callback: types.CallbackQuery):
             else:
                 caption = "VPN ключ не был сгенерирован."
             if os.path.exists(conf_path):
-                with open(conf_path, 'rb') as config:
-                    sent_doc = await bot.send_document(
-                        admin,
-                        config,
-                        caption=caption,
-                        parse_mode="Markdown",
-                        disable_notification=True
-                    )
-                    asyncio.create_task(delete_message_after_delay(admin, sent_doc.message_id, delay=15))
+                sent_doc = await send_cached_file(
+                    'document',
+                    admin,
+                    conf_path,
+                    caption=caption,
+                    parse_mode="Markdown",
+                    disable_notification=True
+                )
+                asyncio.create_task(delete_message_after_delay(admin, sent_doc.message_id, delay=15))
         except FileNotFoundError:
             sent_message = await bot.send_message(admin, "Не удалось найти файлы конфигурации для указанного пользователя.", parse_mode="Markdown", disable_notification=True)
             asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
@@ -566,10 +621,10 @@ async def set_traffic_limit(callback: types.CallbackQuery):
                 args=[client_name],
                 id=client_name
             )
-            db.set_user_expiration(client_name, expiration_time)
+            await aiodb.set_user_expiration(client_name, expiration_time)
             confirmation_text = f"Пользователь **{client_name}** добавлен. Конфигурация истечет через **{duration_choice}**."
         else:
-            db.set_user_expiration(client_name, None)
+            await aiodb.set_user_expiration(client_name, None)
             confirmation_text = f"Пользователь **{client_name}** добавлен с неограниченным временем действия."
         if traffic_limit:
             limit_str = humanize.naturalsize(traffic_limit, binary=True)
@@ -599,37 +654,227 @@ async def set_traffic_limit(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-async def generate_vpn_key(conf_path: str) -> str:
-    try:
-        process = await asyncio.create_subprocess_exec(
-            'python3.11',
-            'awg-decode.py',
-            '--encode',
-            conf_path,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+def bulk_duration_markup():
+    duration_buttons = [
+        InlineKeyboardButton("1 час", callback_data="bulk_duration_1h"),
+        InlineKeyboardButton("1 день", callback_data="bulk_duration_1d"),
+        InlineKeyboardButton("1 неделя", callback_data="bulk_duration_1w"),
+        InlineKeyboardButton("1 месяц", callback_data="bulk_duration_1m"),
+        InlineKeyboardButton("Без ограничений", callback_data="bulk_duration_unlimited"),
+        InlineKeyboardButton("Домой", callback_data="home")
+    ]
+    return InlineKeyboardMarkup(row_width=1).add(*duration_buttons)
+
+def create_clients_zip(zip_filepath, clients):
+    with zipfile.ZipFile(zip_filepath, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+        vpn_keys = []
+        resolve = awg_decode.make_resolver()
+        for name, allowed_ips in clients:
+            conf_path = os.path.join('users', name, f'{name}.conf')
+            png_path = os.path.join('users', name, f'{name}.png')
+            for filepath in (conf_path, png_path):
+                if os.path.exists(filepath):
+                    zipf.write(filepath, os.path.join(name, os.path.basename(filepath)))
+            try:
+                vpn_keys.append(f"{name}\t{allowed_ips}\t{awg_decode.encode_file(conf_path, resolve)}")
+            except (OSError, ValueError):
+                vpn_keys.append(f"{name}\t{allowed_ips}\t")
+        zipf.writestr('vpn_keys.txt', '\n'.join(vpn_keys) + '\n')
+
+@dp.callback_query_handler(lambda c: c.data == "bulk_add")
+async def prompt_for_bulk_names(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    main_chat_id, main_message_id = user_main_messages.get(admin, (None, None))
+    if main_chat_id and main_message_id:
+        await bot.edit_message_text(
+            chat_id=main_chat_id,
+            message_id=main_message_id,
+            text=(
+                "Введите имена пользователей через пробел или запятую, "
+                "либо диапазон вида `team-001..team-500`:"
+            ),
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("Домой", callback_data="home")
+            )
+        )
+        user_main_messages['waiting_for_user_name'] = False
+        user_main_messages['waiting_for_bulk_names'] = True
+    else:
+        await callback_query.answer("Ошибка: главное сообщение не найдено.", show_alert=True)
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_connect_'))
+async def bulk_connect(callback: types.CallbackQuery):
+    if callback.from_user.id != admin:
+        await callback.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    user_main_messages['ipv6'] = callback.data.split('bulk_connect_', 1)[1]
+    main_chat_id, main_message_id = user_main_messages.get(admin, (None, None))
+    if main_chat_id and main_message_id:
+        await bot.edit_message_text(
+            chat_id=main_chat_id,
+            message_id=main_message_id,
+            text="Выберите время действия конфигураций:",
+            reply_markup=bulk_duration_markup()
+        )
+    else:
+        await callback.answer("Ошибка: главное сообщение не найдено.", show_alert=True)
+    await callback.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_duration_'))
+async def bulk_set_duration(callback: types.CallbackQuery):
+    if callback.from_user.id != admin:
+        await callback.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    duration_choice = callback.data.split('bulk_duration_', 1)[1]
+    if duration_choice == '1h':
+        duration = timedelta(hours=1)
+    elif duration_choice == '1d':
+        duration = timedelta(days=1)
+    elif duration_choice == '1w':
+        duration = timedelta(weeks=1)
+    elif duration_choice == '1m':
+        duration = timedelta(days=30)
+    elif duration_choice == 'unlimited':
+        duration = None
+    else:
+        await callback.answer("Неверный выбор времени.", show_alert=True)
+        return
+    user_main_messages['duration'] = duration
+    user_main_messages['duration_choice'] = duration_choice
+    traffic_buttons = [
+        InlineKeyboardButton("5 GB", callback_data="bulk_traffic_5GB"),
+        InlineKeyboardButton("10 GB", callback_data="bulk_traffic_10GB"),
+        InlineKeyboardButton("30 GB", callback_data="bulk_traffic_30GB"),
+        InlineKeyboardButton("100 GB", callback_data="bulk_traffic_100GB"),
+        InlineKeyboardButton("Без ограничений", callback_data="bulk_traffic_unlimited"),
+        InlineKeyboardButton("Домой", callback_data="home")
+    ]
+    main_chat_id, main_message_id = user_main_messages.get(admin, (None, None))
+    if main_chat_id and main_message_id:
+        await bot.edit_message_text(
+            chat_id=main_chat_id,
+            message_id=main_message_id,
+            text="Выберите лимит трафика:",
+            reply_markup=InlineKeyboardMarkup(row_width=1).add(*traffic_buttons)
+        )
+    else:
+        await callback.answer("Ошибка: главное сообщение не найдено.", show_alert=True)
+    await callback.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bulk_traffic_'))
+async def bulk_set_traffic_limit(callback: types.CallbackQuery):
+    if callback.from_user.id != admin:
+        await callback.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    names = user_main_messages.pop('bulk_names', None)
+    main_chat_id, main_message_id = user_main_messages.get(admin, (None, None))
+    if not names or not main_chat_id or not main_message_id:
+        await callback.answer("Ошибка: список пользователей не найден.", show_alert=True)
+        return
+    traffic_choice = callback.data.split('bulk_traffic_', 1)[1]
+    if traffic_choice == 'unlimited':
+        traffic_limit = None
+    else:
+        traffic_limit = int(traffic_choice.replace('GB', '')) * 1024 * 1024 * 1024
+    duration = user_main_messages.get('duration')
+    duration_choice = user_main_messages.get('duration_choice')
+    ipv6 = user_main_messages.get('ipv6') == 'ipv6'
+    await callback.answer()
+    await bot.edit_message_text(
+        chat_id=main_chat_id,
+        message_id=main_message_id,
+        text=f"Добавление клиентов: {len(names)}..."
+    )
+
+    clients, error = await aiodb.root_add_many(names, ipv6=ipv6)
+    if not clients:
+        sent_message = await bot.send_message(
+            admin,
+            f"Не удалось добавить пользователей: {error}",
+            disable_notification=True
         )
-        stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            return ""
-        vpn_key = stdout.decode().strip()
-        if vpn_key.startswith('vpn://'):
-            return vpn_key
+        asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
+    else:
+        created = [name for name, _ in clients]
+        for name in created:
+            traffic_ledger.set(name, traffic_limit, 0, 0)
+        await commit_traffic()
+        if duration:
+            expiration_time = datetime.now(pytz.UTC) + duration
+            for name in created:
+                scheduler.add_job(
+                    deactivate_user,
+                    trigger=DateTrigger(run_date=expiration_time),
+                    args=[name],
+                    id=name,
+                    replace_existing=True
+                )
+            await aiodb.set_users_expiration(created, expiration_time)
+            confirmation_text = f"Добавлено пользователей: **{len(created)}**. Конфигурации истекут через **{duration_choice}**."
+        else:
+            await aiodb.set_users_expiration(created, None)
+            confirmation_text = f"Добавлено пользователей: **{len(created)}** с неограниченным временем действия."
+        if traffic_limit:
+            confirmation_text += f"\nЛимит трафика: {humanize.naturalsize(traffic_limit, binary=True)}"
         else:
-            return ""
+            confirmation_text += "\nЛимит трафика: ♾️ Неограниченно"
+
+        zip_filepath = os.path.join(tempfile.gettempdir(), f"clients_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.zip")
+        try:
+            await asyncio.to_thread(create_clients_zip, zip_filepath, clients)
+            with open(zip_filepath, 'rb') as f:
+                await bot.send_document(
+                    admin,
+                    f,
+                    caption=confirmation_text,
+                    parse_mode="Markdown",
+                    disable_notification=True
+                )
+        except:
+            await bot.send_message(admin, confirmation_text + "\nНе удалось отправить архив с конфигурациями.", parse_mode="Markdown", disable_notification=True)
+        finally:
+            if os.path.exists(zip_filepath):
+                os.remove(zip_filepath)
+
+    await bot.edit_message_text(
+        chat_id=main_chat_id,
+        message_id=main_message_id,
+        text="Выберите действие:",
+        reply_markup=main_menu_markup
+    )
+
+async def generate_vpn_key(conf_path: str) -> str:
+    try:
+        stat = os.stat(conf_path)
+    except OSError:
+        return ""
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = vpn_key_cache.get(conf_path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    try:
+        vpn_key = await asyncio.to_thread(awg_decode.encode_file, conf_path)
     except:
         return ""
+    if not vpn_key.startswith('vpn://'):
+        return ""
+    vpn_key_cache[conf_path] = (signature, vpn_key)
+    return vpn_key
 
 @dp.callback_query_handler(lambda c: c.data.startswith('list_users'))
 async def list_users_callback(callback_query: types.CallbackQuery):
     if callback_query.from_user.id != admin:
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
-    clients = db.get_client_list()
+    clients = await aiodb.get_client_list()
     if not clients:
         await callback_query.answer("Список пользователей пуст.", show_alert=True)
         return
-    active_clients = db.get_active_list()
+    active_clients = await aiodb.get_active_list()
     active_clients_dict = {}
     for client in active_clients:
         username = client[0]
@@ -700,13 +945,13 @@ def parse_transfer(transfer_str):
 async def client_selected_callback(callback_query: types.CallbackQuery):
     _, username = callback_query.data.split('client_', 1)
     username = username.strip()
-    clients = db.get_client_list()
+    clients = await aiodb.get_client_list()
     client_info = next((c for c in clients if c[0] == username), None)
     if not client_info:
         await callback_query.answer("Ошибка: пользователь не найден.", show_alert=True)
         return
-    is_blocked = is_user_blocked(username)
-    expiration_time = db.get_user_expiration(username)
+    is_blocked = await is_user_blocked(username)
+    expiration_time = await aiodb.get_user_expiration(username)
     ipv4 = None
     ipv6 = None
     if client_info[1]:
@@ -726,7 +971,7 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
                 ipv6 = ip_with_mask
             elif '.' in ip_adr:
                 ipv4 = ip_with_mask
-    active_clients = db.get_active_list()
+    active_clients = await aiodb.get_active_list()
     active_info = next((ac for ac in active_clients if ac[0] == username), None)
     now = datetime.now(pytz.UTC)
     if active_info:
@@ -748,8 +993,7 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
         connection_status = '🔴 Офлайн'
         received_bytes = 0
         sent_bytes = 0
-    traffic_limits = load_traffic_limits()
-    user_traffic = traffic_limits.get(username, {'limit': None, 'used': 0})
+    user_traffic = traffic_ledger.get(username) or {'limit': None, 'used': 0}
     traffic_limit = user_traffic.get('limit')
     traffic_used = user_traffic.get('used', 0)
 
@@ -790,6 +1034,9 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
         InlineKeyboardButton("IP info", callback_data=f"ip_info_{username}"),
         InlineKeyboardButton("Подключения", callback_data=f"connections_{username}")
     )
+    keyboard.add(
+        InlineKeyboardButton("Статистика трафика", callback_data=f"usage_stats_{username}")
+    )
     keyboard.add(
         InlineKeyboardButton("Удалить", callback_data=f"delete_user_{username}"),
         InlineKeyboardButton("Разблокировать" if is_blocked else "Заблокировать", callback_data=f"{'unblock' if is_blocked else 'block'}_user_{username}"),
@@ -816,53 +1063,83 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
     await callback_query.answer()
 
 async def update_traffic_usage():
-    traffic_limits = load_traffic_limits()
-    clients_transfer = db.get_all_clients_transfer()
-    for client in clients_transfer:
-        username = client['username']
-        received_bytes = client['received_bytes']
-        sent_bytes = client['sent_bytes']
-        total_bytes = received_bytes + sent_bytes
-        if username in traffic_limits:
-            user_traffic = traffic_limits[username]
-            prev_total = user_traffic.get('prev_total', total_bytes)
-            delta = total_bytes - prev_total
-            if delta < 0:
-                delta = 0
-            user_traffic['used'] += delta
-            user_traffic['prev_total'] = total_bytes
+    async with traffic_poll_lock:
+        try:
+            counters, now = await aiodb.get_peer_counters()
+        except subprocess.CalledProcessError:
+            return
+        elapsed = now - traffic_ledger.polled_at if traffic_ledger.polled_at else None
+        over_limit = []
+        gaps = []
+        for username, peer_counters in counters.items():
+            if username not in traffic_ledger:
+                total = sum(peer_counters.values())
+                traffic_ledger.set(username, None, 0, total)
+                if traffic_ledger.polled_at:
+                    traffic_series.add(username, total, now)
+                continue
+            user_traffic, delta, gap = traffic_ledger.account(username, peer_counters, now)
+            traffic_series.add(username, delta, now)
+            traffic_enforcer.observe(username, delta, elapsed)
+            if gap:
+                gaps.append(gap)
             if user_traffic['limit'] and user_traffic['used'] >= user_traffic['limit']:
-                if not is_user_blocked(username):
-                    success = await block_user(username)
-                    if success:
-                        sent_message = await bot.send_message(
-                            admin,
-                            f"Пользователь **{username}** достиг лимита трафика и был заблокирован.",
-                            parse_mode="Markdown",
-                            disable_notification=True
-                        )
-                        asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
-            traffic_limits[username] = user_traffic
-    save_traffic_limits(traffic_limits)
+                if not await is_user_blocked(username):
+                    over_limit.append(username)
+        traffic_ledger.polled_at = now
+        traffic_enforcer.next_interval(
+            ((username, used, limit) for username, limit, used, _ in traffic_ledger.items()
+             if username not in over_limit),
+            now
+        )
+        await commit_traffic()
+        if gaps:
+            logger.warning(f"Обнаружен сброс счётчиков трафика: {', '.join(gap[0] for gap in gaps)}")
+            await asyncio.to_thread(store.record_traffic_gaps, gaps)
+        if over_limit:
+            results = await block_users(over_limit)
+            for username in over_limit:
+                if results[username]:
+                    traffic = traffic_ledger.get(username)
+                    traffic_enforcer.record_enforcement(username, traffic['used'], traffic['limit'], elapsed)
+                    sent_message = await bot.send_message(
+                        admin,
+                        f"Пользователь **{username}** достиг лимита трафика и был заблокирован.",
+                        parse_mode="Markdown",
+                        disable_notification=True
+                    )
+                    asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
+
+async def refresh_traffic_usage():
+    global traffic_refresh
+    if traffic_refresh is None or traffic_refresh.done():
+        traffic_refresh = asyncio.ensure_future(update_traffic_usage())
+    await asyncio.shield(traffic_refresh)
+
+async def poll_traffic_usage():
+    if traffic_enforcer.due(time.time()):
+        await update_traffic_usage()
 
 @dp.callback_query_handler(lambda c: c.data.startswith('connections_'))
 async def client_connections_callback(callback_query: types.CallbackQuery):
     _, username = callback_query.data.split('connections_', 1)
     username = username.strip()
-    file_path = os.path.join('files', 'connections', f'{username}_ip.json')
-    if not os.path.exists(file_path):
+    await flush_client_endpoints()
+    rows = await asyncio.to_thread(store.get_last_connections, username, 5)
+    if not rows:
         await callback_query.answer("Нет данных о подключениях пользователя.", show_alert=True)
         return
     try:
-        async with aiofiles.open(file_path, 'r') as f:
-            data = json.loads(await f.read())
-        sorted_ips = sorted(data.items(), key=lambda x: datetime.strptime(x[1], '%d.%m.%Y %H:%M'), reverse=True)
-        last_connections = sorted_ips[:5]
-        isp_tasks = [get_isp_info(ip) for ip, _ in last_connections]
+        isp_tasks = [get_isp_info(ip) for ip, _, _, _ in rows]
         isp_results = await asyncio.gather(*isp_tasks)
         connections_text = f"*Последние подключения пользователя {username}:*\n"
-        for (ip, timestamp), isp in zip(last_connections, isp_results):
-            connections_text += f"{ip} ({isp}) - {timestamp}\n"
+        for (ip, first_seen, last_seen, seen_count), isp in zip(rows, isp_results):
+            timestamp = datetime.fromtimestamp(last_seen).strftime('%d.%m.%Y %H:%M')
+            connections_text += f"{ip} ({isp}) - {timestamp}"
+            if seen_count > 1:
+                first_timestamp = datetime.fromtimestamp(first_seen).strftime('%d.%m.%Y')
+                connections_text += f" (×{seen_count}, с {first_timestamp})"
+            connections_text += "\n"
         keyboard = InlineKeyboardMarkup(row_width=2)
         keyboard.add(
             InlineKeyboardButton("Назад", callback_data=f"client_{username}"),
@@ -878,36 +1155,80 @@ async def client_connections_callback(callback_query: types.CallbackQuery):
     except:
         await callback_query.answer("Ошибка при получении данных о подключениях.", show_alert=True)
         return
-    await cleanup_connection_data(username)
+    await callback_query.answer()
+
+def render_sparkline(values):
+    peak = max(values)
+    if not peak:
+        return SPARKLINE[0] * len(values)
+    return ''.join(SPARKLINE[min(len(SPARKLINE) - 1, value * len(SPARKLINE) // peak)] for value in values)
+
+def format_usage_period(title, points, label_format):
+    values = [value for _, value in points]
+    text = f"*{title}:* {humanize.naturalsize(sum(values), binary=True)}\n"
+    text += f"`{render_sparkline(values)}`\n"
+    peak_time, peak_value = max(points, key=lambda point: point[1])
+    if peak_value:
+        text += f"Пик: {datetime.fromtimestamp(peak_time).strftime(label_format)} — {humanize.naturalsize(peak_value, binary=True)}\n"
+    return text
+
+@dp.callback_query_handler(lambda c: c.data.startswith('usage_stats_'))
+async def usage_stats_callback(callback_query: types.CallbackQuery):
+    _, username = callback_query.data.split('usage_stats_', 1)
+    username = username.strip()
+    now = time.time()
+    text = f"*Трафик пользователя {username}:*\n\n"
+    text += format_usage_period("За сутки", traffic_series.series(username, 'hour', 24, now), '%d.%m %H:00')
+    text += format_usage_period("За неделю", traffic_series.series(username, 'day', 7, now), '%d.%m.%Y')
+    text += format_usage_period("За месяц", traffic_series.series(username, 'day', 30, now), '%d.%m.%Y')
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("Назад", callback_data=f"client_{username}"),
+        InlineKeyboardButton("Домой", callback_data="home")
+    )
+    try:
+        await bot.edit_message_text(
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            text=text,
+            parse_mode="Markdown",
+            reply_markup=keyboard
+        )
+    except:
+        await callback_query.answer("Ошибка при получении статистики трафика.", show_alert=True)
+        return
     await callback_query.answer()
 
 @dp.callback_query_handler(lambda c: c.data.startswith('ip_info_'))
 async def ip_info_callback(callback_query: types.CallbackQuery):
     _, username = callback_query.data.split('ip_info_', 1)
     username = username.strip()
-    active_clients = db.get_active_list()
+    active_clients = await aiodb.get_active_list()
     active_info = next((ac for ac in active_clients if ac[0] == username), None)
     if active_info:
         endpoint = active_info[3]
-        ip_address = endpoint.split(':')[0]
+        ip_address = store.endpoint_ip(endpoint)
     else:
         await callback_query.answer("Нет информации о подключении пользователя.", show_alert=True)
         return
     url = f"http://ip-api.com/json/{ip_address}?fields=message,country,countryCode,region,regionName,city,zip,lat,lon,timezone,isp,org,as,hosting"
+    error = None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if 'message' in data:
-                        await callback_query.answer(f"Ошибка при получении данных: {data['message']}", show_alert=True)
-                        return
-                else:
-                    await callback_query.answer(f"Ошибка при запросе к API: {resp.status}", show_alert=True)
-                    return
+        async with isp_lookup.get_session().get(url) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                if 'message' in data:
+                    error = f"Ошибка при получении данных: {data['message']}"
+            else:
+                error = f"Ошибка при запросе к API: {resp.status}"
     except:
-        await callback_query.answer("Ошибка при запросе к API.", show_alert=True)
-        return
+        error = "Ошибка при запросе к API."
+    if error:
+        offline_isp = lookup_offline_isp(ip_address)
+        if not offline_isp:
+            await callback_query.answer(error, show_alert=True)
+            return
+        data = {'isp': offline_isp}
     info_text = f"*IP информация для {username}:*\n"
     for key, value in data.items():
         info_text += f"{key.capitalize()}: {value}\n"
@@ -937,9 +1258,13 @@ async def ip_info_callback(callback_query: types.CallbackQuery):
 @dp.callback_query_handler(lambda c: c.data.startswith('delete_user_'))
 async def client_delete_callback(callback_query: types.CallbackQuery):
     username = callback_query.data.split('delete_user_')[1]
-    success = db.deactive_user_db(username)
+    success = await aiodb.deactive_user_db(username)
     if success:
-        db.remove_user_expiration(username)
+        await asyncio.to_thread(store.remove_client, username)
+        traffic_ledger.remove(username)
+        traffic_series.remove(username)
+        traffic_enforcer.forget(username)
+        await commit_traffic()
         try:
             scheduler.remove_job(job_id=username)
         except:
@@ -984,16 +1309,15 @@ async def client_block_callback(callback_query: types.CallbackQuery):
         return
 
     if action == 'block':
+        await refresh_traffic_usage()
         success = await block_user(username)
         confirmation_text = None if success else f"Не удалось заблокировать пользователя **{username}**."
     else:
-        traffic_limits = load_traffic_limits()
-        user_traffic = traffic_limits.get(username, {})
-        expiration_time = db.get_user_expiration(username)
+        user_traffic = traffic_ledger.get(username) or {}
+        expiration_time = await aiodb.get_user_expiration(username)
         if user_traffic.get('limit') and user_traffic.get('used') >= user_traffic['limit']:
-            user_traffic['used'] = 0
-            traffic_limits[username] = user_traffic
-            save_traffic_limits(traffic_limits)
+            traffic_ledger.set(username, user_traffic['limit'], 0, user_traffic['prev_total'])
+            await commit_traffic()
             traffic_buttons = [
                 InlineKeyboardButton("5 GB", callback_data=f"reset_traffic_5GB_{username}"),
                 InlineKeyboardButton("10 GB", callback_data=f"reset_traffic_10GB_{username}"),
@@ -1077,10 +1401,10 @@ async def unblock_set_duration(callback: types.CallbackQuery):
                 args=[username],
                 id=username
             )
-            db.set_user_expiration(username, expiration_time)
+            await aiodb.set_user_expiration(username, expiration_time)
             confirmation_text = f"Пользователь **{username}** разблокирован. Новый срок действия: {duration_choice}."
         else:
-            db.set_user_expiration(username, None)
+            await aiodb.set_user_expiration(username, None)
             confirmation_text = f"Пользователь **{username}** разблокирован без ограничения по времени."
     else:
         confirmation_text = f"Не удалось разблокировать пользователя **{username}**."
@@ -1109,19 +1433,14 @@ async def reset_traffic_limit(callback: types.CallbackQuery):
         traffic_limit = None
     else:
         traffic_limit = int(traffic_choice.replace('GB', '')) * 1024 * 1024 * 1024
-    clients_transfer = db.get_all_clients_transfer()
+    clients_transfer = await aiodb.get_all_clients_transfer()
     user_transfer = next((ct for ct in clients_transfer if ct['username'] == username), None)
     if user_transfer:
         total_bytes = user_transfer['received_bytes'] + user_transfer['sent_bytes']
     else:
         total_bytes = 0
-    traffic_limits = load_traffic_limits()
-    traffic_limits[username] = {
-        'limit': traffic_limit,
-        'used': 0,
-        'prev_total': total_bytes
-    }
-    save_traffic_limits(traffic_limits)
+    traffic_ledger.set(username, traffic_limit, 0, total_bytes)
+    await commit_traffic()
     success = await unblock_user(username)
     if success:
         confirmation_text = f"Пользователь **{username}** разблокирован. Новый лимит трафика установлен."
@@ -1145,6 +1464,8 @@ async def return_home(callback_query: types.CallbackQuery):
     main_chat_id, main_message_id = user_main_messages.get(admin, (None, None))
     if main_chat_id and main_message_id:
         user_main_messages.pop('waiting_for_user_name', None)
+        user_main_messages.pop('waiting_for_bulk_names', None)
+        user_main_messages.pop('bulk_names', None)
         user_main_messages.pop('client_name', None)
         user_main_messages.pop('ipv6', None)
         try:
@@ -1175,7 +1496,7 @@ async def list_users_for_config(callback_query: types.CallbackQuery):
     if callback_query.from_user.id != admin:
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
-    clients = db.get_client_list()
+    clients = await aiodb.get_client_list()
     if not clients:
         await callback_query.answer("Список пользователей пуст.", show_alert=True)
         return
@@ -1212,9 +1533,8 @@ async def send_user_config(callback_query: types.CallbackQuery):
     try:
         png_path = os.path.join('users', username, f'{username}.png')
         if os.path.exists(png_path):
-            with open(png_path, 'rb') as photo:
-                sent_photo = await bot.send_photo(admin, photo, disable_notification=True)
-                sent_messages.append(sent_photo.message_id)
+            sent_photo = await send_cached_file('photo', admin, png_path, disable_notification=True)
+            sent_messages.append(sent_photo.message_id)
         conf_path = os.path.join('users', username, f'{username}.conf')
         if os.path.exists(conf_path):
             vpn_key = await generate_vpn_key(conf_path)
@@ -1233,15 +1553,25 @@ async def send_user_config(callback_query: types.CallbackQuery):
             else:
                 caption = "VPN ключ не был сгенерирован."
             if os.path.exists(conf_path):
-                with open(conf_path, 'rb') as config:
-                    sent_doc = await bot.send_document(
-                        admin,
-                        config,
-                        caption=caption,
-                        parse_mode="Markdown",
-                        disable_notification=True
-                    )
-                    sent_messages.append(sent_doc.message_id)
+                sent_doc = await send_cached_file(
+                    'document',
+                    admin,
+                    conf_path,
+                    caption=caption,
+                    parse_mode="Markdown",
+                    disable_notification=True
+                )
+                sent_messages.append(sent_doc.message_id)
+            if vpn_key:
+                key_png_path = await asyncio.to_thread(get_vpn_key_qr, username, vpn_key)
+                sent_key_photo = await send_cached_file(
+                    'photo',
+                    admin,
+                    key_png_path,
+                    caption="QR-код VPN ключа для AmneziaVPN",
+                    disable_notification=True
+                )
+                sent_messages.append(sent_key_photo.message_id)
     except:
         sent_message = await bot.send_message(admin, "Произошла ошибка.", parse_mode="Markdown", disable_notification=True)
         asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
@@ -1284,29 +1614,94 @@ async def create_backup_callback(callback_query: types.CallbackQuery):
         await bot.send_message(admin, "Не удалось создать бекап.", disable_notification=True)
     await callback_query.answer()
 
+@dp.callback_query_handler(lambda c: c.data == "regen_qr")
+async def regen_qr_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    await callback_query.answer("Генерация QR-кодов запущена.")
+    try:
+        rendered, failed = await asyncio.to_thread(qr.render_all)
+        text = f"QR-коды обновлены: {rendered}."
+        if failed:
+            names = ', '.join(os.path.basename(os.path.dirname(path)) for path in failed[:10])
+            text += f"\nНе удалось создать: {len(failed)} ({names})."
+    except:
+        text = "Ошибка при генерации QR-кодов."
+    sent_message = await bot.send_message(admin, text, disable_notification=True)
+    asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
+
+@dp.callback_query_handler(lambda c: c.data == "rerender_configs")
+async def rerender_configs_callback(callback_query: types.CallbackQuery):
+    if callback_query.from_user.id != admin:
+        await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        return
+    await callback_query.answer()
+    sent_message = await bot.send_message(admin, "Обновление конфигураций клиентов...", disable_notification=True)
+    progress = {'done': 0, 'total': 0}
+
+    def report(done, total):
+        progress['done'] = done
+        progress['total'] = total
+
+    task = asyncio.create_task(aiodb.rerender_clients(report))
+    shown = None
+    while not task.done():
+        await asyncio.wait({task}, timeout=2)
+        state = (progress['done'], progress['total'])
+        if task.done() or not state[1] or state == shown:
+            continue
+        shown = state
+        try:
+            await bot.edit_message_text(
+                chat_id=admin,
+                message_id=sent_message.message_id,
+                text=f"Обновление конфигураций клиентов: {state[0]}/{state[1]}"
+            )
+        except:
+            pass
+    try:
+        result = task.result()
+        text = f"Конфигурации обновлены: {result.changed}, без изменений: {result.unchanged}."
+        if result.missing:
+            text += f"\nНет файла или ключа клиента: {', '.join(result.missing[:10])}."
+        if result.failed:
+            text += f"\nНе удалось создать QR-код: {', '.join(result.failed[:10])}."
+    except:
+        text = "Ошибка при обновлении конфигураций клиентов."
+    try:
+        await bot.edit_message_text(chat_id=admin, message_id=sent_message.message_id, text=text)
+    except:
+        pass
+    asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=30))
+
 @dp.callback_query_handler(lambda c: c.data == "reload_config")
 async def reload_config_callback(callback_query: types.CallbackQuery):
     if callback_query.from_user.id != admin:
         await callback_query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
         return
     interface_name = os.path.basename(WG_CONFIG_FILE).split('.')[0]
+    await update_traffic_usage()
     try:
-        process_down = await asyncio.create_subprocess_shell(
-            f"{WG_QUICK_CMD} down {interface_name}",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout_down, stderr_down = await process_down.communicate()
-        if process_down.returncode != 0:
-            raise Exception()
-        process_up = await asyncio.create_subprocess_shell(
-            f"{WG_QUICK_CMD} up {interface_name}",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout_up, stderr_up = await process_up.communicate()
-        if process_up.returncode != 0:
-            raise Exception()
+        async with traffic_poll_lock:
+            process_down = await asyncio.create_subprocess_shell(
+                f"{WG_QUICK_CMD} down {interface_name}",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout_down, stderr_down = await process_down.communicate()
+            if process_down.returncode != 0:
+                raise Exception()
+            await reset_traffic_counters()
+            process_up = await asyncio.create_subprocess_shell(
+                f"{WG_QUICK_CMD} up {interface_name}",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout_up, stderr_up = await process_up.communicate()
+            db.invalidate_wg_snapshot()
+            if process_up.returncode != 0:
+                raise Exception()
     except:
         await bot.send_message(admin, "Ошибка при перезагрузке конфигурации.", disable_notification=True)
     finally:
@@ -1335,7 +1730,8 @@ async def process_unknown_callback(callback_query: types.CallbackQuery):
     await callback_query.answer("Неизвестная команда.", show_alert=True)
 
 async def deactivate_user(client_name: str):
-    if not is_user_blocked(client_name):
+    if not await is_user_blocked(client_name):
+        await refresh_traffic_usage()
         success = await block_user(client_name)
         if success:
             sent_message = await bot.send_message(
@@ -1346,7 +1742,7 @@ async def deactivate_user(client_name: str):
             )
             asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
             
-            db.set_user_expiration(client_name, datetime.now(pytz.UTC))
+            await aiodb.set_user_expiration(client_name, datetime.now(pytz.UTC))
         else:
             sent_message = await bot.send_message(
                 admin,
@@ -1356,14 +1752,17 @@ async def deactivate_user(client_name: str):
             )
             asyncio.create_task(delete_message_after_delay(admin, sent_message.message_id, delay=15))
     else:
-        db.set_user_expiration(client_name, datetime.now(pytz.UTC))
+        await aiodb.set_user_expiration(client_name, datetime.now(pytz.UTC))
 
 
 async def on_startup(dp):
-    os.makedirs('files/connections', exist_ok=True)
+    os.makedirs('files', exist_ok=True)
     os.makedirs('users', exist_ok=True)
+    qr.start_pool()
+    await asyncio.to_thread(store.get_connection)
+    await asyncio.to_thread(db.load_client_endpoints)
     await load_isp_cache_task()
-    users = db.get_users_with_expiration()
+    users = await aiodb.get_users_with_expiration()
     for user in users:
         client_name, expiration_time = user
         if expiration_time:
@@ -1380,22 +1779,35 @@ async def on_startup(dp):
                     args=[client_name],
                     id=client_name
                 )
-            elif not is_user_blocked(client_name):
+            elif not await is_user_blocked(client_name):
                 await deactivate_user(client_name)
 
-    traffic_limits = load_traffic_limits()
-    clients_transfer = db.get_all_clients_transfer()
-    for client in clients_transfer:
-        username = client['username']
-        received_bytes = client['received_bytes']
-        sent_bytes = client['sent_bytes']
-        total_bytes = received_bytes + sent_bytes
-        if username in traffic_limits:
-            user_traffic = traffic_limits[username]
-            user_traffic['prev_total'] = total_bytes
-            traffic_limits[username] = user_traffic
-    save_traffic_limits(traffic_limits)
+    await asyncio.to_thread(traffic_ledger.load)
+    await load_traffic_series()
+    await update_traffic_usage()
+
+    scheduler.add_job(
+        poll_traffic_usage,
+        'interval',
+        seconds=traffic_enforcer.min_interval,
+        id='traffic_usage',
+        coalesce=True,
+        max_instances=1,
+        misfire_grace_time=None
+    )
+    scheduler.add_job(checkpoint_traffic, 'interval', seconds=LEDGER_CHECKPOINT_INTERVAL)
+    scheduler.add_job(compact_traffic_series, 'interval', hours=24)
+    scheduler.add_job(flush_client_endpoints, 'interval', seconds=ENDPOINTS_FLUSH_INTERVAL)
+    scheduler.add_job(compact_connection_history, 'interval', hours=6, next_run_time=datetime.now(pytz.UTC))
+
+async def on_shutdown(dp):
+    await checkpoint_traffic()
+    await flush_client_endpoints()
+    await flush_isp_cache()
+    await isp_lookup.close()
+    qr.stop_pool()
 
-    scheduler.add_job(update_traffic_usage, 'interval', seconds=15)
+async def flush_client_endpoints():
+    await asyncio.to_thread(db.flush_client_endpoints)
 
-executor.start_polling(dp, on_startup=on_startup)
+executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -1,16 +1,33 @@
 import os
 import subprocess
 import configparser
-import json
 import pytz
+import wgconf
+import store
+import provision
 import glob
 import sys
 import socket
 import re
+import time
+import threading
+from collections import namedtuple
 from datetime import datetime
 
-EXPIRATIONS_FILE = 'files/expirations.json'
 UTC = pytz.UTC
+SNAPSHOT_TTL = 2
+
+PeerRecord = namedtuple('PeerRecord', [
+    'interface', 'public_key', 'endpoint', 'allowed_ips',
+    'latest_handshake', 'rx_bytes', 'tx_bytes'
+])
+
+_wg_snapshot = {'time': 0, 'peers': None}
+
+_client_endpoints = {}
+_pending_endpoints = {}
+_seen_endpoints = {}
+_endpoints_lock = threading.Lock()
 
 def check_installed_vpn():
     installed_vpn = []
@@ -126,83 +143,127 @@ def create_config(path='files/setting.ini'):
         config.set("setting", "endpoint", endpoint)
         config.write(f)
 
-def save_client_endpoint(username, endpoint):
-    os.makedirs('files/connections', exist_ok=True)
-    file_path = os.path.join('files', 'connections', f'{username}_ip.json')
-    timestamp = datetime.now().strftime('%d.%m.%Y %H:%M')
-    ip_address = endpoint.split(':')[0]
-
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as f:
-            try:
-                data = json.load(f)
-            except json.JSONDecodeError:
-                data = {}
-    else:
-        data = {}
+def load_client_endpoints():
+    with _endpoints_lock:
+        _client_endpoints.update(store.get_latest_endpoints())
+
+def track_client_endpoint(username, endpoint):
+    ip_address = store.endpoint_ip(endpoint)
+    with _endpoints_lock:
+        if _client_endpoints.get(username) == ip_address:
+            _seen_endpoints[(username, ip_address)] = int(time.time())
+            return
+        _client_endpoints[username] = ip_address
+        _pending_endpoints[(username, ip_address)] = int(time.time())
+
+def flush_client_endpoints():
+    with _endpoints_lock:
+        if not _pending_endpoints and not _seen_endpoints:
+            return
+        rows = [(username, ip, last_seen) for (username, ip), last_seen in _pending_endpoints.items()]
+        seen = [(username, ip, last_seen) for (username, ip), last_seen in _seen_endpoints.items()]
+        _pending_endpoints.clear()
+        _seen_endpoints.clear()
+    if rows:
+        store.record_connections(rows)
+    if seen:
+        store.touch_connections(seen)
+
+def parse_wg_dump(interface, output):
+    peers = {}
+    lines = output.strip().split('\n')
+    for line in lines[1:]:
+        parts = line.split('\t')
+        if len(parts) < 8:
+            continue
+        public_key, _, endpoint, allowed_ips, latest_handshake, rx_bytes, tx_bytes = parts[:7]
+        peers[public_key] = PeerRecord(
+            interface,
+            public_key,
+            endpoint,
+            allowed_ips,
+            int(latest_handshake),
+            int(rx_bytes),
+            int(tx_bytes)
+        )
+    return peers
 
-    data[ip_address] = timestamp
+def get_cached_wg_snapshot():
+    if _wg_snapshot['peers'] is not None and time.monotonic() - _wg_snapshot['time'] < SNAPSHOT_TTL:
+        return _wg_snapshot['peers']
+    return None
 
-    with open(file_path, 'w') as f:
-        json.dump(data, f)
+def set_wg_snapshot(peers):
+    _wg_snapshot['time'] = time.monotonic()
+    _wg_snapshot['peers'] = peers
 
-def get_all_clients_transfer():
+def get_wg_snapshot():
+    peers = get_cached_wg_snapshot()
+    if peers is not None:
+        return peers
 
-    setting = get_config()
-    wg_config_file = setting['wg_config_file']
     WG_CMD = get_wg_cmd()
+    interfaces = subprocess.check_output([WG_CMD, 'show', 'interfaces']).decode('utf-8').split()
 
-    try:
-        call = subprocess.check_output(
-            f"awk '/^# BEGIN_PEER / {{peer=$3}}; /^PublicKey/ {{print peer, $3}}' {wg_config_file}",
-            shell=True
-        )
-        client_data = call.decode('utf-8').strip().split('\n')
-
-        client_key = {}
-        for data in client_data:
-            if data:
-                parts = data.strip().split()
-                if len(parts) >= 2:
-                    name = parts[0].strip()
-                    public_key = parts[1].strip()
-                    client_key[public_key] = name
-
-        call = subprocess.check_output(f"{WG_CMD} show interfaces", shell=True)
-        interfaces = call.decode('utf-8').strip().split('\n')
-
-        clients_transfer = {}
-
-        for interface in interfaces:
-            call = subprocess.check_output(f"{WG_CMD} show {interface} transfer", shell=True)
-            transfer_output = call.decode('utf-8').strip().split('\n')
-
-
-            for line in transfer_output:
-                parts = line.strip().split()
-                if len(parts) == 3:
-                    public_key = parts[0].strip()
-                    received_bytes = int(parts[1].strip())
-                    sent_bytes = int(parts[2].strip())
-
-                    username = client_key.get(public_key)
-                    if username:
-                        if username not in clients_transfer:
-                            clients_transfer[username] = {'received_bytes': 0, 'sent_bytes': 0}
-                        clients_transfer[username]['received_bytes'] += received_bytes
-                        clients_transfer[username]['sent_bytes'] += sent_bytes
-
-        return [
-            {
-                'username': username,
-                'received_bytes': data['received_bytes'],
-                'sent_bytes': data['sent_bytes']
-            }
-            for username, data in clients_transfer.items()
-        ]
+    peers = {}
+    for interface in interfaces:
+        output = subprocess.check_output([WG_CMD, 'show', interface, 'dump']).decode('utf-8')
+        peers.update(parse_wg_dump(interface, output))
 
-    except subprocess.CalledProcessError as e:
+    set_wg_snapshot(peers)
+    return peers
+
+def invalidate_wg_snapshot():
+    _wg_snapshot['peers'] = None
+
+def get_config_index():
+    setting = get_config()
+    return wgconf.get_index(setting['wg_config_file'])
+
+def update_config(transform):
+    setting = get_config()
+    return wgconf.update_config(setting['wg_config_file'], transform)
+
+def set_peers_blocked(names, blocked):
+    return update_config(lambda data, index: wgconf.set_blocked(data, index, names, blocked))
+
+def get_client_keys():
+    return get_config_index().keys
+
+def build_clients_transfer(peers, client_key):
+    clients_transfer = {}
+    for public_key, peer in peers.items():
+        username = client_key.get(public_key)
+        if username:
+            if username not in clients_transfer:
+                clients_transfer[username] = {'received_bytes': 0, 'sent_bytes': 0}
+            clients_transfer[username]['received_bytes'] += peer.rx_bytes
+            clients_transfer[username]['sent_bytes'] += peer.tx_bytes
+
+    return [
+        {
+            'username': username,
+            'received_bytes': data['received_bytes'],
+            'sent_bytes': data['sent_bytes']
+        }
+        for username, data in clients_transfer.items()
+    ]
+
+def build_peer_counters(peers, client_key):
+    counters = {}
+    for public_key, peer in peers.items():
+        username = client_key.get(public_key)
+        if username:
+            counters.setdefault(username, {})[public_key] = peer.rx_bytes + peer.tx_bytes
+    return counters
+
+def get_all_clients_transfer():
+    try:
+        client_key = get_client_keys()
+        peers = get_wg_snapshot()
+    except subprocess.CalledProcessError:
         return []
+    return build_clients_transfer(peers, client_key)
 
 def get_config(path='files/setting.ini'):
     if not os.path.exists(path):
@@ -223,163 +284,113 @@ def root_add(id_user, ipv6=False):
     wg_config_file = setting['wg_config_file']
     WG_CMD = get_wg_cmd()
 
-    cmd = ["./newclient.sh", id_user, endpoint, wg_config_file, WG_CMD]
-    if ipv6:
-        cmd.append('ipv6')
-
-    return subprocess.call(cmd) == 0
-
-def get_client_list():
-    setting = get_config()
-    wg_config_file = setting['wg_config_file']
-
     try:
-        call = subprocess.check_output(f"awk '/# BEGIN_PEER/ {{print $3}}' {wg_config_file}", shell=True)
-        client_list = call.decode('utf-8').strip().split('\n')
-
-        call = subprocess.check_output(f"awk '/AllowedIPs/ {{sub(/AllowedIPs = /,\"\"); print}}' {wg_config_file}", shell=True)
-        ip_list = call.decode('utf-8').strip().split('\n')
-
-        return [[client, ip_list[n].strip()] for n, client in enumerate(client_list) if client]
-    except subprocess.CalledProcessError:
-        return []
-
-def get_active_list():
-    import subprocess
-    import re
-
+        provision.add_client(id_user, endpoint, wg_config_file, WG_CMD, ipv6=ipv6)
+    except provision.ProvisioningError as e:
+        print(f"Ошибка при добавлении клиента: {e}")
+        return False
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Ошибка при добавлении клиента: {e}")
+        return False
+    invalidate_wg_snapshot()
+    return True
+
+def root_add_many(names, ipv6=False):
     setting = get_config()
+    endpoint = setting['endpoint']
     wg_config_file = setting['wg_config_file']
     WG_CMD = get_wg_cmd()
 
     try:
-        call = subprocess.check_output(
-            f"awk '/^# BEGIN_PEER / {{peer=$3}}; /^PublicKey/ {{print peer, $3}}' {wg_config_file}",
-            shell=True
-        )
-        client_data = call.decode('utf-8').strip().split('\n')
-
-        client_key = {}
-        for data in client_data:
-            if data:
-                parts = data.strip().split()
-                if len(parts) >= 2:
-                    name = parts[0].strip()
-                    public_key = parts[1].strip()
-                    client_key[public_key] = name
-
-        call = subprocess.check_output(f"{WG_CMD} show interfaces", shell=True)
-        interfaces = call.decode('utf-8').strip().split('\n')
-
-        active_clients = []
-
-        for interface in interfaces:
-            call = subprocess.check_output(f"{WG_CMD} show {interface} peers", shell=True)
-            peers = call.decode('utf-8').strip().split('\n')
-
-            call = subprocess.check_output(f"{WG_CMD} show {interface} latest-handshakes", shell=True)
-            handshake_output = call.decode('utf-8').strip().split('\n')
-            handshake_dict = {}
-            for line in handshake_output:
-                parts = line.strip().split('\t')
-                if len(parts) == 2:
-                    peer_key = parts[0].strip()
-                    handshake_time = parts[1].strip()
-                    handshake_dict[peer_key] = handshake_time
-
-            call = subprocess.check_output(f"{WG_CMD} show {interface} endpoints", shell=True)
-            endpoints_output = call.decode('utf-8').strip().split('\n')
-            endpoint_dict = {}
-            for line in endpoints_output:
-                parts = line.strip().split('\t')
-                if len(parts) == 2:
-                    peer_key = parts[0].strip()
-                    endpoint = parts[1].strip()
-                    endpoint_dict[peer_key] = endpoint
-
-            call = subprocess.check_output(f"{WG_CMD} show {interface} transfer", shell=True)
-            transfer_output = call.decode('utf-8').strip().split('\n')
-            transfer_dict = {}
-            for line in transfer_output:
-                parts = line.strip().split()
-                if len(parts) == 3:
-                    peer_key = parts[0].strip()
-                    rx_bytes = int(parts[1].strip())
-                    tx_bytes = int(parts[2].strip())
-                    transfer_dict[peer_key] = (rx_bytes, tx_bytes)
-
-            for peer in peers:
-                peer = peer.strip()
-                username = client_key.get(peer)
-                if username:
-                    latest_handshake = handshake_dict.get(peer, '0')
-                    endpoint = endpoint_dict.get(peer, 'N/A')
-                    rx_bytes, tx_bytes = transfer_dict.get(peer, (0, 0))
-                    transfer_info = f"{rx_bytes} bytes received, {tx_bytes} bytes sent"
-
-                    if latest_handshake != '0':
-                        latest_handshake_time = datetime.fromtimestamp(int(latest_handshake), pytz.UTC)
-                        last_handshake_str = str(int(latest_handshake_time.timestamp()))
-                    else:
-                        last_handshake_str = '0'
-
-                    save_client_endpoint(username, endpoint)
-                    active_clients.append([username, last_handshake_str, transfer_info, endpoint])
+        clients = provision.add_clients(names, endpoint, wg_config_file, WG_CMD, ipv6=ipv6)
+    except provision.ProvisioningError as e:
+        return [], str(e)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Ошибка при добавлении клиентов: {e}")
+        return [], "Не удалось применить конфигурацию."
+    invalidate_wg_snapshot()
+    return clients, None
+
+def rerender_clients(progress=None):
+    setting = get_config()
+    return provision.rerender_clients(setting['wg_config_file'], setting['endpoint'], progress)
 
-        return active_clients
+def get_client_list():
+    peers = get_config_index().peers
+    return [[name, peer.allowed_ips] for name, peer in peers.items()]
+
+def build_active_list(peers, client_key):
+    active_clients = []
+    for public_key, peer in peers.items():
+        username = client_key.get(public_key)
+        if username:
+            transfer_info = f"{peer.rx_bytes} bytes received, {peer.tx_bytes} bytes sent"
+            if peer.endpoint != '(none)':
+                track_client_endpoint(username, peer.endpoint)
+            active_clients.append([username, str(peer.latest_handshake), transfer_info, peer.endpoint])
+    return active_clients
 
+def get_active_list():
+    try:
+        client_key = get_client_keys()
+        peers = get_wg_snapshot()
     except subprocess.CalledProcessError as e:
         print(f"Ошибка при получении активных клиентов: {e}")
         return []
+    return build_active_list(peers, client_key)
+
+def get_interface_name():
+    setting = get_config()
+    return provision.get_interface_name(setting['wg_config_file'])
 
 def deactive_user_db(id_user):
     setting = get_config()
     wg_config_file = setting['wg_config_file']
     WG_CMD = get_wg_cmd()
 
-    return subprocess.call(["./removeclient.sh", id_user, wg_config_file, WG_CMD]) == 0
+    try:
+        provision.remove_client(id_user, wg_config_file, WG_CMD)
+    except provision.ProvisioningError as e:
+        print(f"Ошибка при удалении клиента: {e}")
+        return False
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Ошибка при удалении клиента: {e}")
+        return False
+    invalidate_wg_snapshot()
+    return True
 
 def load_expirations():
-    if not os.path.exists(EXPIRATIONS_FILE):
-        return {}
-    with open(EXPIRATIONS_FILE, 'r') as f:
-        try:
-            data = json.load(f)
-            for user, timestamp in data.items():
-                if timestamp:
-                    data[user] = datetime.fromisoformat(timestamp).replace(tzinfo=UTC)
-                else:
-                    data[user] = None
-            return data
-        except json.JSONDecodeError:
-            return {}
-
-def save_expirations(expirations):
-    os.makedirs(os.path.dirname(EXPIRATIONS_FILE), exist_ok=True)
-    data = {user: (ts.isoformat() if ts else None) for user, ts in expirations.items()}
-    with open(EXPIRATIONS_FILE, 'w') as f:
-        json.dump(data, f)
+    data = store.get_expirations()
+    for user, timestamp in data.items():
+        if timestamp:
+            data[user] = datetime.fromisoformat(timestamp).replace(tzinfo=UTC)
+        else:
+            data[user] = None
+    return data
 
 def set_user_expiration(username: str, expiration: datetime):
-    expirations = load_expirations()
     if expiration:
         if expiration.tzinfo is None:
             expiration = expiration.replace(tzinfo=UTC)
-        expirations[username] = expiration
+        store.set_expiration(username, expiration.isoformat())
     else:
-        expirations[username] = None
-    save_expirations(expirations)
+        store.set_expiration(username, None)
 
-def remove_user_expiration(username: str):
-    expirations = load_expirations()
-    if username in expirations:
-        del expirations[username]
-        save_expirations(expirations)
+def set_users_expiration(usernames, expiration: datetime):
+    if expiration:
+        if expiration.tzinfo is None:
+            expiration = expiration.replace(tzinfo=UTC)
+        expires_at = expiration.isoformat()
+    else:
+        expires_at = None
+    store.set_expirations([(username, expires_at) for username in usernames])
 
 def get_users_with_expiration():
     expirations = load_expirations()
     return [(user, ts.isoformat() if ts else None) for user, ts in expirations.items()]
 
 def get_user_expiration(username: str):
-    expirations = load_expirations()
-    return expirations.get(username, None)
+    timestamp = store.get_expiration(username)
+    if timestamp:
+        return datetime.fromisoformat(timestamp).replace(tzinfo=UTC)
+    return None
@@ -0,0 +1,73 @@
+from collections import deque
+
+MIN_INTERVAL = 2
+MAX_INTERVAL = 15
+IDLE_INTERVAL = 60
+DEFAULT_INTERVAL = 15
+SAFETY = 0.5
+ALPHA = 0.5
+IDLE_RATE = 1024
+
+class EnforcementScheduler:
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, idle_interval=IDLE_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_interval = max(idle_interval, max_interval)
+        self.interval = DEFAULT_INTERVAL
+        self.next_poll = 0
+        self.rates = {}
+        self.lags = deque(maxlen=100)
+        self.overshoots = deque(maxlen=100)
+        self.polls = 0
+
+    def observe(self, username, delta, elapsed):
+        if not elapsed or elapsed <= 0:
+            return
+        rate = delta / elapsed
+        previous = self.rates.get(username)
+        self.rates[username] = rate if previous is None else ALPHA * rate + (1 - ALPHA) * previous
+
+    def forget(self, username):
+        self.rates.pop(username, None)
+
+    def time_to_limit(self, used, limit, rate):
+        if rate < IDLE_RATE:
+            return None
+        return max(0, limit - used) / rate
+
+    def due(self, now):
+        return now + self.min_interval / 2 >= self.next_poll
+
+    def next_interval(self, clients, now):
+        self.polls += 1
+        interval = self.idle_interval
+        for username, used, limit in clients:
+            if not limit or used >= limit:
+                continue
+            interval = min(interval, self.max_interval)
+            seconds = self.time_to_limit(used, limit, self.rates.get(username, 0))
+            if seconds is not None:
+                interval = min(interval, seconds * SAFETY)
+        self.interval = max(self.min_interval, interval)
+        self.next_poll = now + self.interval
+        return self.interval
+
+    def record_enforcement(self, username, used, limit, elapsed):
+        overshoot = max(0, used - limit)
+        rate = self.rates.get(username, 0)
+        lag = overshoot / rate if rate else elapsed or 0
+        self.overshoots.append(overshoot)
+        self.lags.append(min(lag, elapsed) if elapsed else lag)
+        self.forget(username)
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'polls': self.polls,
+            'tracked': sum(1 for rate in self.rates.values() if rate >= IDLE_RATE),
+            'enforcements': len(self.lags),
+            'lag_avg': sum(self.lags) / len(self.lags) if self.lags else 0,
+            'lag_max': max(self.lags) if self.lags else 0,
+            'overshoot_avg': sum(self.overshoots) / len(self.overshoots) if self.overshoots else 0,
+            'overshoot_max': max(self.overshoots) if self.overshoots else 0
+        }
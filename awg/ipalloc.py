@@ -0,0 +1,94 @@
+import ipaddress
+
+MAX_BITMAP_SIZE = 2 ** 24
+
+class PoolExhausted(Exception):
+    pass
+
+class AddressPool:
+    def __init__(self, network, reserved=()):
+        self.network = network
+        self.base = int(network.network_address)
+        self.size = network.num_addresses
+        if network.version == 4 and network.prefixlen < 31:
+            self.first = 1
+            self.last = self.size - 2
+        else:
+            self.first = 1
+            self.last = self.size - 1
+        if self.size <= MAX_BITMAP_SIZE:
+            self.bitmap = bytearray((self.size + 7) // 8)
+            self.used = None
+        else:
+            self.bitmap = None
+            self.used = set()
+        self.free = []
+        self.cursor = self.first
+        self.count = 0
+        for address in reserved:
+            self.mark(address)
+
+    def _offset(self, address):
+        offset = int(ipaddress.ip_address(address)) - self.base
+        if offset < 0 or offset >= self.size:
+            return None
+        return offset
+
+    def _is_used(self, offset):
+        if self.bitmap is not None:
+            return self.bitmap[offset >> 3] & (1 << (offset & 7))
+        return offset in self.used
+
+    def _set(self, offset):
+        if self.bitmap is not None:
+            self.bitmap[offset >> 3] |= 1 << (offset & 7)
+        else:
+            self.used.add(offset)
+        self.count += 1
+
+    def _clear(self, offset):
+        if self.bitmap is not None:
+            self.bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+        else:
+            self.used.discard(offset)
+        self.count -= 1
+
+    def mark(self, address):
+        offset = self._offset(address)
+        if offset is None or self._is_used(offset):
+            return False
+        self._set(offset)
+        return True
+
+    def allocate(self):
+        while self.free:
+            offset = self.free.pop()
+            if not self._is_used(offset):
+                self._set(offset)
+                return ipaddress.ip_address(self.base + offset)
+        while self.cursor <= self.last:
+            offset = self.cursor
+            self.cursor += 1
+            if not self._is_used(offset):
+                self._set(offset)
+                return ipaddress.ip_address(self.base + offset)
+        raise PoolExhausted(f"Подсеть {self.network} заполнена.")
+
+    def release(self, address):
+        offset = self._offset(address)
+        if offset is None or offset < self.first or offset > self.last or not self._is_used(offset):
+            return False
+        self._clear(offset)
+        if offset < self.cursor:
+            self.free.append(offset)
+        return True
+
+def build_pools(ipv4_network, ipv6_network, server_addresses, used_addresses):
+    pools = {4: AddressPool(ipv4_network, server_addresses)}
+    if ipv6_network is not None:
+        pools[6] = AddressPool(ipv6_network, server_addresses)
+    for address in used_addresses:
+        pool = pools.get(address.version)
+        if pool and address in pool.network:
+            pool.mark(address)
+    return pools
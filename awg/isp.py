@@ -0,0 +1,192 @@
+import asyncio
+import time
+from collections import OrderedDict
+import aiohttp
+
+BATCH_URL = 'http://ip-api.com/batch?fields=status,message,isp,query'
+BATCH_SIZE = 100
+BATCH_DELAY = 0.05
+REQUESTS_PER_MINUTE = 15
+REQUEST_TIMEOUT = 10
+CACHE_SIZE = 10000
+CACHE_TTL = 24 * 60 * 60
+NEGATIVE_TTL = 15 * 60
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self):
+        while True:
+            now = self._refill()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def update(self, remaining, reset_after):
+        self._refill()
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+        if remaining == 0 and reset_after:
+            self.blocked_until = time.monotonic() + reset_after
+
+class IspCache:
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.dirty = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.writes = 0
+
+    def get(self, ip, now=None):
+        now = time.time() if now is None else now
+        entry = self.entries.get(ip)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        isp, expires_at = entry
+        if now >= expires_at:
+            del self.entries[ip]
+            self.expired += 1
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(ip)
+        if isp is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, isp
+
+    def put(self, ip, isp, timestamp=None, persist=True):
+        timestamp = time.time() if timestamp is None else timestamp
+        ttl = self.ttl if isp is not None else self.negative_ttl
+        self.entries[ip] = (isp, timestamp + ttl)
+        self.entries.move_to_end(ip)
+        if isp is not None and persist:
+            self.dirty[ip] = (isp, timestamp)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def take_dirty(self):
+        rows = [(ip, isp, timestamp) for ip, (isp, timestamp) in self.dirty.items()]
+        self.dirty = {}
+        self.writes += len(rows)
+        return rows
+
+    def purge(self, now=None):
+        now = time.time() if now is None else now
+        for ip in [ip for ip, (_, expires_at) in self.entries.items() if now >= expires_at]:
+            del self.entries[ip]
+            self.expired += 1
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'dirty': len(self.dirty),
+            'writes': self.writes
+        }
+
+def _header_int(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+class IspLookup:
+    def __init__(self, url=BATCH_URL, batch_size=BATCH_SIZE, delay=BATCH_DELAY, requests_per_minute=REQUESTS_PER_MINUTE):
+        self.url = url
+        self.batch_size = batch_size
+        self.delay = delay
+        self.bucket = TokenBucket(requests_per_minute, 60)
+        self.session = None
+        self.inflight = {}
+        self.pending = []
+        self.task = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=4),
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+            )
+        return self.session
+
+    async def lookup(self, ip):
+        future = self.inflight.get(ip)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.inflight[ip] = future
+            self.pending.append(ip)
+            if self.task is None or self.task.done():
+                self.task = asyncio.create_task(self._run())
+        return await asyncio.shield(future)
+
+    async def _run(self):
+        try:
+            while self.pending:
+                await asyncio.sleep(self.delay)
+                batch = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+                results = {}
+                try:
+                    results = await self._request(batch)
+                except Exception:
+                    pass
+                finally:
+                    self._resolve(batch, results)
+        finally:
+            batch = self.pending[:]
+            self.pending.clear()
+            self._resolve(batch, {})
+
+    def _resolve(self, batch, results):
+        for ip in batch:
+            future = self.inflight.pop(ip, None)
+            if future is not None and not future.done():
+                future.set_result(results.get(ip))
+
+    async def _request(self, ips):
+        await self.bucket.acquire()
+        async with self.get_session().post(self.url, json=ips) as resp:
+            self.bucket.update(_header_int(resp.headers, 'X-Rl'), _header_int(resp.headers, 'X-Ttl'))
+            if resp.status != 200:
+                return {}
+            data = await resp.json(content_type=None)
+        if not isinstance(data, list):
+            return {}
+        return {
+            item['query']: item.get('isp') or 'Unknown ISP'
+            for item in data
+            if isinstance(item, dict) and item.get('status') == 'success' and 'query' in item
+        }
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
@@ -0,0 +1,202 @@
+import os
+import struct
+import threading
+from array import array
+import store
+
+JOURNAL_FILE = 'files/traffic.journal'
+JOURNAL_MAX_SIZE = 4 * 1024 * 1024
+RECORD = struct.Struct('<Hqqq')
+NO_LIMIT = -1
+REMOVED = -2
+
+class TrafficLedger:
+    def __init__(self, journal_path=JOURNAL_FILE):
+        self.journal_path = journal_path
+        self.slots = {}
+        self.names = []
+        self.limits = array('q')
+        self.used = array('q')
+        self.prev_totals = array('q')
+        self.free = []
+        self.dirty = set()
+        self.removed = set()
+        self.pending = bytearray()
+        self.peer_totals = {}
+        self.polled_at = None
+        self.lock = threading.RLock()
+
+    def __contains__(self, username):
+        return username in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _put(self, username, limit, used, prev_total):
+        slot = self.slots.get(username)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+                self.names[slot] = username
+                self.limits[slot] = limit
+                self.used[slot] = used
+                self.prev_totals[slot] = prev_total
+            else:
+                slot = len(self.names)
+                self.names.append(username)
+                self.limits.append(limit)
+                self.used.append(used)
+                self.prev_totals.append(prev_total)
+            self.slots[username] = slot
+        else:
+            self.limits[slot] = limit
+            self.used[slot] = used
+            self.prev_totals[slot] = prev_total
+
+    def _drop(self, username):
+        slot = self.slots.pop(username, None)
+        if slot is not None:
+            self.names[slot] = None
+            self.free.append(slot)
+
+    def _journal(self, username, limit, used, prev_total):
+        name = username.encode('utf-8')
+        self.pending += RECORD.pack(len(name), limit, used, prev_total) + name
+
+    def get(self, username):
+        slot = self.slots.get(username)
+        if slot is None:
+            return None
+        limit = self.limits[slot]
+        return {
+            'limit': None if limit == NO_LIMIT else limit,
+            'used': self.used[slot],
+            'prev_total': self.prev_totals[slot]
+        }
+
+    def items(self):
+        for username, slot in self.slots.items():
+            limit = self.limits[slot]
+            yield username, None if limit == NO_LIMIT else limit, self.used[slot], self.prev_totals[slot]
+
+    def set(self, username, limit, used, prev_total):
+        limit = NO_LIMIT if not limit else int(limit)
+        with self.lock:
+            self.peer_totals.pop(username, None)
+            self._put(username, limit, int(used), int(prev_total))
+            self._journal(username, limit, int(used), int(prev_total))
+            self.dirty.add(username)
+            self.removed.discard(username)
+
+    def mark_reset(self, username):
+        with self.lock:
+            slot = self.slots.get(username)
+            if slot is None:
+                return
+            self.peer_totals.pop(username, None)
+            self.prev_totals[slot] = 0
+            self._journal(username, self.limits[slot], self.used[slot], 0)
+            self.dirty.add(username)
+
+    def account(self, username, counters, now):
+        with self.lock:
+            slot = self.slots.get(username)
+            if slot is None:
+                return None
+            prev_total = self.prev_totals[slot]
+            total = sum(counters.values())
+            previous = self.peer_totals.get(username)
+            reset = False
+            if previous is not None and all(key in previous for key in counters):
+                delta = 0
+                for public_key, value in counters.items():
+                    if value >= previous[public_key]:
+                        delta += value - previous[public_key]
+                    else:
+                        delta += value
+                        reset = True
+            elif total >= prev_total:
+                delta = total - prev_total
+            else:
+                delta = total
+                reset = True
+            self.peer_totals[username] = dict(counters)
+
+            gap = None
+            if reset:
+                interval = int(now - self.polled_at) if self.polled_at else None
+                gap = (username, int(now), prev_total, total, interval)
+            if delta or total != prev_total:
+                self.used[slot] += delta
+                self.prev_totals[slot] = total
+                self._journal(username, self.limits[slot], self.used[slot], total)
+                self.dirty.add(username)
+            return self.get(username), delta, gap
+
+    def remove(self, username):
+        with self.lock:
+            self.peer_totals.pop(username, None)
+            self._drop(username)
+            self._journal(username, REMOVED, 0, 0)
+            self.dirty.discard(username)
+            self.removed.add(username)
+
+    def replay(self, data):
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            name_length, limit, used, prev_total = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + name_length
+            if end > len(data):
+                break
+            username = data[offset + RECORD.size:end].decode('utf-8', 'replace')
+            if limit == REMOVED:
+                self._drop(username)
+                self.dirty.discard(username)
+                self.removed.add(username)
+            else:
+                self._put(username, limit, used, prev_total)
+                self.dirty.add(username)
+                self.removed.discard(username)
+            offset = end
+        return offset
+
+    def load(self):
+        with self.lock:
+            for username, data in store.get_traffic_limits().items():
+                self._put(username, data['limit'] or NO_LIMIT, data['used'] or 0, data['prev_total'] or 0)
+            try:
+                with open(self.journal_path, 'rb') as f:
+                    self.replay(f.read())
+            except OSError:
+                pass
+            self.checkpoint()
+
+    def commit(self):
+        with self.lock:
+            if not self.pending:
+                return
+            os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+            with open(self.journal_path, 'ab') as f:
+                f.write(self.pending)
+                size = f.tell()
+            self.pending.clear()
+            if size > JOURNAL_MAX_SIZE:
+                self.checkpoint()
+
+    def checkpoint(self):
+        with self.lock:
+            self.pending.clear()
+            rows = {}
+            for username in self.dirty:
+                traffic = self.get(username)
+                if traffic is not None:
+                    rows[username] = traffic
+            if rows:
+                store.save_traffic_limits(rows)
+            if self.removed:
+                store.remove_traffic(list(self.removed))
+            os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+            with open(self.journal_path, 'wb') as f:
+                os.fsync(f.fileno())
+            self.dirty.clear()
+            self.removed.clear()
@@ -27,6 +27,9 @@ ENDPOINT="$2"
 WG_CONFIG_FILE="$3"
 WG_CMD="$4"
 
+exec 9>"$WG_CONFIG_FILE.lock"
+flock 9
+
 if [ "$5" == "ipv6" ]; then
     IPV6="yes"
 else
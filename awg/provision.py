@@ -0,0 +1,487 @@
+import os
+import re
+import base64
+import ipaddress
+import subprocess
+import threading
+from collections import namedtuple
+import qr
+import wgconf
+import ipalloc
+
+P = 2 ** 255 - 19
+A24 = 121665
+BASEPOINT = (9).to_bytes(32, 'little')
+
+DEFAULT_DNS = '8.8.8.8, 8.8.4.4'
+AMNEZIA_OPTIONS = ('Jc', 'Jmin', 'Jmax', 'S1', 'S2', 'H1', 'H2', 'H3', 'H4')
+AMNEZIA_DEFAULTS = {
+    'Jc': '4',
+    'Jmin': '15',
+    'Jmax': '1268',
+    'S1': '131',
+    'S2': '45',
+    'H1': '1004746675',
+    'H2': '1157755290',
+    'H3': '1273046607',
+    'H4': '2137162994'
+}
+CLIENT_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]+$')
+RANGE_RE = re.compile(r'^([a-zA-Z0-9_-]*?)(\d+)\.\.([a-zA-Z0-9_-]*?)(\d+)$')
+MAX_BULK_CLIENTS = 1000
+
+PEER_TEMPLATE = """# BEGIN_PEER {name}
+[Peer]
+PublicKey = {public_key}
+PresharedKey = {preshared_key}
+AllowedIPs = {allowed_ips}
+# END_PEER {name}
+"""
+
+CLIENT_TEMPLATE = """[Interface]
+Address = {allowed_ips}
+DNS = {dns}
+PrivateKey = {private_key}
+{amnezia}[Peer]
+PublicKey = {server_public_key}
+PresharedKey = {preshared_key}
+AllowedIPs = {client_allowed_ips}
+Endpoint = {endpoint}:{listen_port}
+PersistentKeepalive = 25
+"""
+
+RerenderResult = namedtuple('RerenderResult', ['changed', 'unchanged', 'missing', 'failed'])
+
+_server_key = {'private': None, 'public': None}
+_server_params = {'index': None, 'params': None}
+_pools = {'key': None, 'pools': None}
+_lock = threading.Lock()
+
+class ProvisioningError(Exception):
+    pass
+
+def x25519(scalar, u_bytes):
+    k = bytearray(scalar)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    k = int.from_bytes(k, 'little')
+    u = bytearray(u_bytes)
+    u[31] &= 127
+    x1 = int.from_bytes(u, 'little')
+
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        k_t = (k >> t) & 1
+        swap ^= k_t
+        if swap:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = k_t
+
+        a = x2 + z2
+        aa = a * a % P
+        b = x2 - z2
+        bb = b * b % P
+        e = aa - bb
+        c = x3 + z3
+        d = x3 - z3
+        da = d * a % P
+        cb = c * b % P
+        x3 = (da + cb) ** 2 % P
+        z3 = x1 * (da - cb) ** 2 % P
+        x2 = aa * bb % P
+        z2 = e * (aa + A24 * e) % P
+
+    if swap:
+        x2, x3 = x3, x2
+        z2, z3 = z3, z2
+    return (x2 * pow(z2, P - 2, P) % P).to_bytes(32, 'little')
+
+def generate_private_key():
+    key = bytearray(os.urandom(32))
+    key[0] &= 248
+    key[31] &= 127
+    key[31] |= 64
+    return base64.b64encode(bytes(key)).decode('ascii')
+
+def generate_preshared_key():
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+def get_public_key(private_key):
+    return base64.b64encode(x25519(base64.b64decode(private_key), BASEPOINT)).decode('ascii')
+
+def get_server_public_key(private_key):
+    if _server_key['private'] != private_key:
+        _server_key['public'] = get_public_key(private_key)
+        _server_key['private'] = private_key
+    return _server_key['public']
+
+def get_interface_name(wg_config_file):
+    return os.path.basename(wg_config_file).split('.')[0]
+
+def is_amnezia(wg_config_file):
+    return 'amnezia' in wg_config_file.lower()
+
+def get_server_params(index, wg_config_file):
+    if _server_params['index'] is index:
+        return _server_params['params']
+
+    interface = index.interface
+    private_key = interface.get('PrivateKey')
+    if not private_key:
+        raise ProvisioningError("В конфигурации сервера не найден PrivateKey.")
+
+    ipv4_network = None
+    ipv6_network = None
+    server_addresses = []
+    for address in interface.get('Address', '').split(','):
+        address = address.strip()
+        if not address:
+            continue
+        try:
+            server_interface = ipaddress.ip_interface(address)
+        except ValueError:
+            continue
+        server_addresses.append(server_interface.ip)
+        network = server_interface.network
+        if network.version == 4 and ipv4_network is None:
+            ipv4_network = network
+        elif network.version == 6 and ipv6_network is None:
+            ipv6_network = ipaddress.ip_network(f'{network.network_address}/64', strict=False)
+    if ipv4_network is None:
+        raise ProvisioningError("В конфигурации сервера не найдена внутренняя IPv4 подсеть.")
+
+    amnezia = ''
+    if is_amnezia(wg_config_file):
+        amnezia = ''.join(
+            f"{option} = {interface.get(option, AMNEZIA_DEFAULTS[option])}\n"
+            for option in AMNEZIA_OPTIONS
+        )
+
+    params = {
+        'server_public_key': get_server_public_key(private_key),
+        'ipv4_network': ipv4_network,
+        'ipv6_network': ipv6_network,
+        'server_addresses': server_addresses,
+        'dns': interface.get('DNS') or DEFAULT_DNS,
+        'listen_port': interface.get('ListenPort', ''),
+        'amnezia': amnezia
+    }
+    _server_params['index'] = index
+    _server_params['params'] = params
+    return params
+
+def get_used_addresses(index):
+    used = set()
+    for peer in index.peers.values():
+        for address in peer.allowed_ips.split(','):
+            address = address.strip()
+            if not address:
+                continue
+            try:
+                used.add(ipaddress.ip_interface(address).ip)
+            except ValueError:
+                continue
+    return used
+
+def get_pools_key(index, params):
+    return (
+        params['ipv4_network'],
+        params['ipv6_network'],
+        tuple(params['server_addresses']),
+        tuple(peer.allowed_ips for peer in index.peers.values())
+    )
+
+def get_pools(index, params):
+    key = get_pools_key(index, params)
+    if _pools['key'] != key:
+        _pools['pools'] = ipalloc.build_pools(
+            params['ipv4_network'],
+            params['ipv6_network'],
+            params['server_addresses'],
+            get_used_addresses(index)
+        )
+        _pools['key'] = key
+    return _pools['pools']
+
+def update_pools_key(index, wg_config_file):
+    if _pools['key'] is not None:
+        _pools['key'] = get_pools_key(index, get_server_params(index, wg_config_file))
+
+def allocate_addresses(pools, ipv6):
+    if ipv6 and 6 not in pools:
+        raise ProvisioningError("В конфигурации сервера не найдена IPv6 подсеть.")
+    try:
+        ipv4_address = pools[4].allocate()
+    except ipalloc.PoolExhausted as e:
+        raise ProvisioningError(str(e))
+    if not ipv6:
+        return f"{ipv4_address}/32"
+    try:
+        ipv6_address = pools[6].allocate()
+    except ipalloc.PoolExhausted as e:
+        pools[4].release(ipv4_address)
+        raise ProvisioningError(str(e))
+    return f"{ipv4_address}/32, {ipv6_address}/128"
+
+def release_addresses(pools, allowed_ips):
+    for address in allowed_ips.split(','):
+        address = address.strip()
+        if not address:
+            continue
+        try:
+            ip = ipaddress.ip_interface(address).ip
+        except ValueError:
+            continue
+        pool = pools.get(ip.version)
+        if pool:
+            pool.release(ip)
+
+def render_peer(name, public_key, preshared_key, allowed_ips):
+    return PEER_TEMPLATE.format(
+        name=name,
+        public_key=public_key,
+        preshared_key=preshared_key,
+        allowed_ips=allowed_ips
+    )
+
+def render_client_config(params, endpoint, private_key, preshared_key, allowed_ips):
+    client_allowed_ips = '0.0.0.0/0, ::/0' if ':' in allowed_ips else '0.0.0.0/0'
+    return CLIENT_TEMPLATE.format(
+        allowed_ips=allowed_ips,
+        dns=params['dns'],
+        private_key=private_key,
+        amnezia=params['amnezia'],
+        server_public_key=params['server_public_key'],
+        preshared_key=preshared_key,
+        client_allowed_ips=client_allowed_ips,
+        endpoint=endpoint,
+        listen_port=params['listen_port']
+    )
+
+def write_client_files(name, client_config):
+    user_dir = os.path.join('users', name)
+    os.makedirs(user_dir, exist_ok=True)
+    conf_path = os.path.join(user_dir, f'{name}.conf')
+    with open(conf_path, 'w') as f:
+        f.write(client_config)
+    return conf_path
+
+def apply_peer(wg_cmd, interface_name, public_key, preshared_key, allowed_ips):
+    subprocess.run(
+        [
+            wg_cmd, 'set', interface_name,
+            'peer', public_key,
+            'preshared-key', '/dev/stdin',
+            'allowed-ips', allowed_ips.replace(' ', '')
+        ],
+        input=preshared_key.encode('ascii'),
+        check=True,
+        capture_output=True
+    )
+
+def append_config(wg_config_file, text, names=()):
+    def append(data, index):
+        existing = [name for name in names if name in index.peers]
+        if existing:
+            raise ProvisioningError(f"Клиенты уже существуют: {', '.join(existing[:10])}")
+        if data and not data.endswith(b'\n'):
+            data += b'\n'
+        return data + text.encode('utf-8')
+    return wgconf.update_config(wg_config_file, append)
+
+def remove_peer(wg_cmd, interface_name, public_key):
+    subprocess.run(
+        [wg_cmd, 'set', interface_name, 'peer', public_key, 'remove'],
+        check=True,
+        capture_output=True
+    )
+
+def apply_peers(wg_cmd, interface_name, peers_text):
+    subprocess.run(
+        [wg_cmd, 'addconf', interface_name, '/dev/stdin'],
+        input=peers_text.encode('utf-8'),
+        check=True,
+        capture_output=True
+    )
+
+def expand_names(text):
+    names = []
+    for token in re.split(r'[\s,;]+', text.strip()):
+        if not token:
+            continue
+        match = RANGE_RE.match(token)
+        if match:
+            prefix, start, end_prefix, end = match.groups()
+            if end_prefix and end_prefix != prefix:
+                raise ProvisioningError(f"Неверный диапазон: {token}")
+            first, last = int(start), int(end)
+            if first > last:
+                raise ProvisioningError(f"Неверный диапазон: {token}")
+            if last - first + 1 + len(names) > MAX_BULK_CLIENTS:
+                raise ProvisioningError(f"Можно добавить не более {MAX_BULK_CLIENTS} клиентов за раз.")
+            width = len(start)
+            names.extend(f"{prefix}{number:0{width}d}" for number in range(first, last + 1))
+        else:
+            names.append(token)
+    if len(names) > MAX_BULK_CLIENTS:
+        raise ProvisioningError(f"Можно добавить не более {MAX_BULK_CLIENTS} клиентов за раз.")
+    for name in names:
+        if not CLIENT_NAME_RE.match(name):
+            raise ProvisioningError(f"Недопустимое имя клиента: {name}")
+    if len(set(names)) != len(names):
+        raise ProvisioningError("Имена клиентов повторяются.")
+    return names
+
+def add_clients(names, endpoint, wg_config_file, wg_cmd, ipv6=False):
+    for name in names:
+        if not CLIENT_NAME_RE.match(name):
+            raise ProvisioningError("Имя клиента может содержать только буквы, цифры, дефисы и подчёркивания.")
+
+    with _lock:
+        index = wgconf.get_index(wg_config_file)
+        existing = [name for name in names if name in index.peers]
+        if existing:
+            raise ProvisioningError(f"Клиенты уже существуют: {', '.join(existing[:10])}")
+        params = get_server_params(index, wg_config_file)
+        pools = get_pools(index, params)
+
+        clients = []
+        try:
+            for name in names:
+                allowed_ips = allocate_addresses(pools, ipv6)
+                private_key = generate_private_key()
+                clients.append({
+                    'name': name,
+                    'private_key': private_key,
+                    'public_key': get_public_key(private_key),
+                    'preshared_key': generate_preshared_key(),
+                    'allowed_ips': allowed_ips
+                })
+            peers_text = ''.join(
+                render_peer(client['name'], client['public_key'], client['preshared_key'], client['allowed_ips'])
+                for client in clients
+            )
+            update_pools_key(append_config(wg_config_file, peers_text, names), wg_config_file)
+        except (ProvisioningError, OSError):
+            for client in clients:
+                release_addresses(pools, client['allowed_ips'])
+            raise
+
+    try:
+        conf_paths = []
+        for client in clients:
+            client_config = render_client_config(
+                params, endpoint, client['private_key'], client['preshared_key'], client['allowed_ips']
+            )
+            conf_paths.append(write_client_files(client['name'], client_config))
+        qr.render_confs(conf_paths)
+
+        interface_name = get_interface_name(wg_config_file)
+        if len(clients) == 1:
+            client = clients[0]
+            apply_peer(wg_cmd, interface_name, client['public_key'], client['preshared_key'], client['allowed_ips'])
+        else:
+            apply_peers(wg_cmd, interface_name, peers_text)
+    except Exception:
+        rollback_clients(wg_config_file, clients)
+        raise
+    return [(client['name'], client['allowed_ips']) for client in clients]
+
+def rollback_clients(wg_config_file, clients):
+    names = {client['name'] for client in clients}
+
+    def cut(data, index):
+        for peer in sorted((index.peers[name] for name in names if name in index.peers), key=lambda peer: peer.start, reverse=True):
+            data = data[:peer.start] + data[peer.end:]
+        return data
+
+    with _lock:
+        index = wgconf.update_config(wg_config_file, cut)
+        if _pools['key'] is not None:
+            for client in clients:
+                release_addresses(_pools['pools'], client['allowed_ips'])
+            update_pools_key(index, wg_config_file)
+
+    for name in names:
+        remove_client_files(name)
+
+def add_client(name, endpoint, wg_config_file, wg_cmd, ipv6=False):
+    return add_clients([name], endpoint, wg_config_file, wg_cmd, ipv6)[0][1]
+
+def remove_client(name, wg_config_file, wg_cmd):
+    removed = []
+
+    def cut(data, index):
+        peer = index.peers.get(name)
+        if peer is None:
+            raise ProvisioningError(f"Клиент {name} не найден.")
+        removed.append(peer)
+        return data[:peer.start] + data[peer.end:]
+
+    with _lock:
+        index = wgconf.update_config(wg_config_file, cut)
+        peer = removed[0]
+        if _pools['key'] is not None:
+            release_addresses(_pools['pools'], peer.allowed_ips)
+            update_pools_key(index, wg_config_file)
+
+    if peer.public_key and not peer.blocked:
+        remove_peer(wg_cmd, get_interface_name(wg_config_file), peer.public_key)
+
+    remove_client_files(name)
+    return peer
+
+def remove_client_files(name):
+    user_dir = os.path.join('users', name)
+    for filename in (f'{name}.conf', f'{name}.png', f'{name}_key.png', f'{name}_key.png.key'):
+        path = os.path.join(user_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.isdir(user_dir) and not os.listdir(user_dir):
+        os.rmdir(user_dir)
+
+def read_private_key(client_config):
+    for line in client_config.splitlines():
+        key, _, value = line.partition('=')
+        if key.strip() == 'PrivateKey':
+            return value.strip()
+    return None
+
+def rerender_clients(wg_config_file, endpoint, progress=None):
+    index = wgconf.get_index(wg_config_file)
+    params = get_server_params(index, wg_config_file)
+
+    changed = []
+    unchanged = 0
+    missing = []
+    for name, peer in index.peers.items():
+        conf_path = os.path.join('users', name, f'{name}.conf')
+        png_path = os.path.join('users', name, f'{name}.png')
+        try:
+            with open(conf_path, 'r') as f:
+                current = f.read()
+        except OSError:
+            missing.append(name)
+            continue
+        private_key = read_private_key(current)
+        if not private_key:
+            missing.append(name)
+            continue
+        client_config = render_client_config(params, endpoint, private_key, peer.preshared_key, peer.allowed_ips)
+        if client_config == current and os.path.exists(png_path):
+            unchanged += 1
+            continue
+        if client_config != current:
+            write_client_files(name, client_config)
+        changed.append(conf_path)
+
+    failed = []
+    for done, (conf_path, result) in enumerate(zip(changed, qr.iter_render_confs(changed)), 1):
+        if result is None:
+            failed.append(os.path.basename(os.path.dirname(conf_path)))
+        if progress:
+            progress(done, len(changed))
+    return RerenderResult(len(changed), unchanged, missing, failed)
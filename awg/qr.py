@@ -0,0 +1,82 @@
+import io
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import qrcode
+from qrcode.image.pure import PyPNGImage
+
+BOX_SIZE = 3
+BORDER = 4
+MIN_BATCH = 8
+
+_pool = None
+
+def render_png(text):
+    code = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=BOX_SIZE,
+        border=BORDER,
+        image_factory=PyPNGImage
+    )
+    code.add_data(text.encode('utf-8'))
+    code.make(fit=True)
+    buffer = io.BytesIO()
+    code.make_image().save(buffer)
+    return buffer.getvalue()
+
+def write_png(text, png_path):
+    data = render_png(text)
+    temp_path = f'{png_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, png_path)
+    return png_path
+
+def render_conf(conf_path):
+    png_path = os.path.splitext(conf_path)[0] + '.png'
+    try:
+        with open(conf_path, 'r') as f:
+            write_png(f.read(), png_path)
+    except (OSError, ValueError, qrcode.exceptions.DataOverflowError):
+        return None
+    return png_path
+
+def start_pool(max_workers=None):
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+        _pool.submit(int).result()
+    return _pool
+
+def stop_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+def iter_render_confs(conf_paths):
+    conf_paths = list(conf_paths)
+    if _pool is None or len(conf_paths) < MIN_BATCH:
+        for path in conf_paths:
+            yield render_conf(path)
+        return
+    yield from _pool.map(render_conf, conf_paths, chunksize=4)
+
+def render_confs(conf_paths):
+    return list(iter_render_confs(conf_paths))
+
+def find_confs(users_dir='users'):
+    conf_paths = []
+    if not os.path.isdir(users_dir):
+        return conf_paths
+    for name in sorted(os.listdir(users_dir)):
+        conf_path = os.path.join(users_dir, name, f'{name}.conf')
+        if os.path.isfile(conf_path):
+            conf_paths.append(conf_path)
+    return conf_paths
+
+def render_all(users_dir='users'):
+    conf_paths = find_confs(users_dir)
+    results = render_confs(conf_paths)
+    failed = [path for path, result in zip(conf_paths, results) if result is None]
+    return len(conf_paths) - len(failed), failed
@@ -21,6 +21,9 @@ CLIENT_NAME="$1"
 WG_CONFIG_FILE="$2"
 WG_CMD="$3"
 
+exec 9>"$WG_CONFIG_FILE.lock"
+flock 9
+
 WG_QUICK_CMD="${WG_CMD}-quick"
 
 sed -i "/^# BEGIN_PEER $CLIENT_NAME$/, /^# END_PEER $CLIENT_NAME$/d" "$WG_CONFIG_FILE"
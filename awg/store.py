@@ -0,0 +1,396 @@
+import os
+import json
+import ipaddress
+import sqlite3
+import threading
+from datetime import datetime
+
+DB_FILE = 'files/bot.db'
+EXPIRATIONS_FILE = 'files/expirations.json'
+TRAFFIC_LIMITS_FILE = 'files/traffic_limits.json'
+ISP_CACHE_FILE = 'files/isp_cache.json'
+CONNECTIONS_DIR = 'files/connections'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    name TEXT PRIMARY KEY,
+    created_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS expirations (
+    username TEXT PRIMARY KEY,
+    expires_at TEXT
+);
+CREATE INDEX IF NOT EXISTS expirations_expires_at ON expirations (expires_at);
+CREATE TABLE IF NOT EXISTS traffic (
+    username TEXT PRIMARY KEY,
+    traffic_limit INTEGER,
+    used INTEGER NOT NULL DEFAULT 0,
+    prev_total INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS connection_history (
+    username TEXT NOT NULL,
+    ip BLOB NOT NULL,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    seen_count INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (username, ip)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS connection_history_last_seen ON connection_history (username, last_seen);
+CREATE TABLE IF NOT EXISTS isp_cache (
+    ip TEXT PRIMARY KEY,
+    isp TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS isp_cache_timestamp ON isp_cache (timestamp);
+CREATE TABLE IF NOT EXISTS traffic_gaps (
+    username TEXT NOT NULL,
+    detected_at INTEGER NOT NULL,
+    previous_total INTEGER NOT NULL,
+    current_total INTEGER NOT NULL,
+    interval INTEGER
+);
+CREATE INDEX IF NOT EXISTS traffic_gaps_detected_at ON traffic_gaps (username, detected_at);
+CREATE TABLE IF NOT EXISTS traffic_series (
+    username TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    PRIMARY KEY (username, resolution, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS telegram_files (
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    PRIMARY KEY (path, sha256)
+) WITHOUT ROWID;
+"""
+
+_conn = None
+_lock = threading.RLock()
+
+def get_connection():
+    global _conn
+    with _lock:
+        if _conn is None:
+            os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
+            conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            _conn = conn
+            migrate_json_files()
+        return _conn
+
+def execute(sql, params=()):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            return conn.execute(sql, params)
+
+def executemany(sql, rows):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            conn.executemany(sql, rows)
+
+def fetchall(sql, params=()):
+    with _lock:
+        return get_connection().execute(sql, params).fetchall()
+
+def backup(path):
+    with _lock:
+        target = sqlite3.connect(path)
+        try:
+            get_connection().backup(target)
+        finally:
+            target.close()
+
+def close():
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+def _load_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _mark_migrated(path):
+    os.replace(path, f'{path}.migrated')
+
+def pack_ip(ip):
+    return ipaddress.ip_address(ip).packed
+
+def endpoint_ip(endpoint):
+    return endpoint.rpartition(':')[0].strip('[]')
+
+def unpack_ip(data):
+    return str(ipaddress.ip_address(bytes(data)))
+
+def migrate_json_files():
+    conn = _conn
+    names = set()
+
+    if os.path.exists(EXPIRATIONS_FILE):
+        data = _load_json(EXPIRATIONS_FILE)
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO expirations (username, expires_at) VALUES (?, ?)',
+                data.items()
+            )
+        names.update(data)
+        _mark_migrated(EXPIRATIONS_FILE)
+
+    if os.path.exists(TRAFFIC_LIMITS_FILE):
+        data = _load_json(TRAFFIC_LIMITS_FILE)
+        rows = []
+        for username, traffic in data.items():
+            limit = traffic.get('limit')
+            rows.append((
+                username,
+                int(limit) if limit else None,
+                int(traffic.get('used') or 0),
+                int(traffic.get('prev_total') or 0)
+            ))
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO traffic (username, traffic_limit, used, prev_total) VALUES (?, ?, ?, ?)',
+                rows
+            )
+        names.update(data)
+        _mark_migrated(TRAFFIC_LIMITS_FILE)
+
+    if os.path.exists(ISP_CACHE_FILE):
+        data = _load_json(ISP_CACHE_FILE)
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO isp_cache (ip, isp, timestamp) VALUES (?, ?, ?)',
+                [(ip, item['isp'], item['timestamp']) for ip, item in data.items()]
+            )
+        _mark_migrated(ISP_CACHE_FILE)
+
+    if os.path.isdir(CONNECTIONS_DIR):
+        for filename in os.listdir(CONNECTIONS_DIR):
+            if not filename.endswith('_ip.json'):
+                continue
+            path = os.path.join(CONNECTIONS_DIR, filename)
+            username = filename[:-len('_ip.json')]
+            rows = []
+            for ip, timestamp in _load_json(path).items():
+                try:
+                    last_seen = int(datetime.strptime(timestamp, '%d.%m.%Y %H:%M').timestamp())
+                    rows.append((username, pack_ip(ip), last_seen, last_seen))
+                except ValueError:
+                    continue
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO connection_history (username, ip, first_seen, last_seen) VALUES (?, ?, ?, ?)',
+                    rows
+                )
+            names.add(username)
+            _mark_migrated(path)
+
+    if names:
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO clients (name) VALUES (?)',
+                [(name,) for name in names]
+            )
+
+def add_client(name, created_at=None):
+    add_clients([name], created_at)
+
+def add_clients(names, created_at=None):
+    executemany(
+        'INSERT OR IGNORE INTO clients (name, created_at) VALUES (?, ?)',
+        [(name, created_at) for name in names]
+    )
+
+def remove_client(name):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            for table, column in (
+                ('clients', 'name'),
+                ('expirations', 'username'),
+                ('traffic', 'username'),
+                ('traffic_gaps', 'username'),
+                ('traffic_series', 'username'),
+                ('connection_history', 'username')
+            ):
+                conn.execute(f'DELETE FROM {table} WHERE {column} = ?', (name,))
+            prefix = os.path.join('users', name, '')
+            conn.execute(
+                'DELETE FROM telegram_files WHERE substr(path, 1, length(?)) = ?',
+                (prefix, prefix)
+            )
+
+def get_expirations():
+    return dict(fetchall('SELECT username, expires_at FROM expirations'))
+
+def get_expiration(username):
+    rows = fetchall('SELECT expires_at FROM expirations WHERE username = ?', (username,))
+    return rows[0][0] if rows else None
+
+def set_expiration(username, expires_at):
+    execute(
+        'INSERT OR REPLACE INTO expirations (username, expires_at) VALUES (?, ?)',
+        (username, expires_at)
+    )
+
+def set_expirations(rows):
+    executemany(
+        'INSERT OR REPLACE INTO expirations (username, expires_at) VALUES (?, ?)',
+        rows
+    )
+
+def get_traffic_limits():
+    rows = fetchall('SELECT username, traffic_limit, used, prev_total FROM traffic')
+    return {
+        username: {'limit': limit, 'used': used, 'prev_total': prev_total}
+        for username, limit, used, prev_total in rows
+    }
+
+def save_traffic_limits(limits):
+    executemany(
+        'INSERT OR REPLACE INTO traffic (username, traffic_limit, used, prev_total) VALUES (?, ?, ?, ?)',
+        [
+            (username, data.get('limit'), data.get('used', 0), data.get('prev_total', 0))
+            for username, data in limits.items()
+        ]
+    )
+
+def remove_traffic(usernames):
+    executemany('DELETE FROM traffic WHERE username = ?', [(username,) for username in usernames])
+
+def record_traffic_gaps(rows):
+    executemany(
+        'INSERT INTO traffic_gaps (username, detected_at, previous_total, current_total, interval) VALUES (?, ?, ?, ?, ?)',
+        rows
+    )
+
+def count_traffic_gaps(since):
+    return fetchall('SELECT COUNT(*) FROM traffic_gaps WHERE detected_at >= ?', (since,))[0][0]
+
+def save_traffic_series(rows):
+    executemany(
+        'INSERT OR REPLACE INTO traffic_series (username, resolution, bucket, bytes) VALUES (?, ?, ?, ?)',
+        rows
+    )
+
+def get_traffic_series(oldest_buckets):
+    rows = []
+    for resolution, bucket in oldest_buckets.items():
+        rows += fetchall(
+            'SELECT username, resolution, bucket, bytes FROM traffic_series WHERE resolution = ? AND bucket >= ?',
+            (resolution, bucket)
+        )
+    return rows
+
+def compact_traffic_series(oldest_buckets):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            for resolution, bucket in oldest_buckets.items():
+                conn.execute(
+                    'DELETE FROM traffic_series WHERE resolution = ? AND bucket < ?',
+                    (resolution, bucket)
+                )
+
+def record_connections(rows):
+    packed = []
+    for username, ip, seen in rows:
+        try:
+            packed.append((username, pack_ip(ip), seen, seen))
+        except ValueError:
+            continue
+    executemany(
+        'INSERT INTO connection_history (username, ip, first_seen, last_seen) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (username, ip) DO UPDATE SET '
+        'last_seen = MAX(last_seen, excluded.last_seen), seen_count = seen_count + 1',
+        packed
+    )
+
+def touch_connections(rows):
+    packed = []
+    for username, ip, seen in rows:
+        try:
+            packed.append((username, pack_ip(ip), seen, seen))
+        except ValueError:
+            continue
+    executemany(
+        'INSERT INTO connection_history (username, ip, first_seen, last_seen) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (username, ip) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)',
+        packed
+    )
+
+def get_latest_endpoints():
+    rows = fetchall(
+        'SELECT username, ip FROM connection_history c WHERE last_seen = '
+        '(SELECT MAX(last_seen) FROM connection_history WHERE username = c.username)'
+    )
+    return {username: unpack_ip(ip) for username, ip in rows}
+
+def get_last_connections(username, limit):
+    rows = fetchall(
+        'SELECT ip, first_seen, last_seen, seen_count FROM connection_history '
+        'WHERE username = ? ORDER BY last_seen DESC LIMIT ?',
+        (username, limit)
+    )
+    return [(unpack_ip(ip), first_seen, last_seen, seen_count) for ip, first_seen, last_seen, seen_count in rows]
+
+def compact_connections(min_last_seen, keep_per_client):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            expired = conn.execute(
+                'DELETE FROM connection_history WHERE last_seen < ?',
+                (min_last_seen,)
+            ).rowcount
+            trimmed = conn.execute(
+                'DELETE FROM connection_history WHERE (username, ip) IN ('
+                'SELECT username, ip FROM ('
+                'SELECT username, ip, ROW_NUMBER() OVER '
+                '(PARTITION BY username ORDER BY last_seen DESC) AS position '
+                'FROM connection_history) WHERE position > ?)',
+                (keep_per_client,)
+            ).rowcount
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return expired + trimmed
+
+def get_isp_cache(limit=-1):
+    rows = fetchall(
+        'SELECT ip, isp, timestamp FROM isp_cache ORDER BY timestamp DESC LIMIT ?',
+        (limit,)
+    )
+    return [(ip, isp, timestamp) for ip, isp, timestamp in reversed(rows)]
+
+def save_isps(rows):
+    executemany(
+        'INSERT OR REPLACE INTO isp_cache (ip, isp, timestamp) VALUES (?, ?, ?)',
+        rows
+    )
+
+def delete_isp_older_than(timestamp):
+    execute('DELETE FROM isp_cache WHERE timestamp < ?', (timestamp,))
+
+def get_file_id(path, sha256):
+    rows = fetchall(
+        'SELECT file_id FROM telegram_files WHERE path = ? AND sha256 = ?',
+        (path, sha256)
+    )
+    return rows[0][0] if rows else None
+
+def save_file_id(path, sha256, file_id):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            conn.execute('DELETE FROM telegram_files WHERE path = ?', (path,))
+            conn.execute(
+                'INSERT INTO telegram_files (path, sha256, file_id) VALUES (?, ?, ?)',
+                (path, sha256, file_id)
+            )
@@ -0,0 +1,86 @@
+import threading
+from array import array
+
+RESOLUTIONS = {
+    'hour': (3600, 24),
+    'day': (86400, 31)
+}
+
+class Ring:
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.values = array('Q', bytes(8 * size))
+        self.buckets = array('I', bytes(4 * size))
+
+    def add(self, bucket, value):
+        slot = bucket % self.size
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.values[slot] = 0
+        self.values[slot] += value
+        return self.values[slot]
+
+    def set(self, bucket, value):
+        slot = bucket % self.size
+        self.buckets[slot] = bucket
+        self.values[slot] = value
+
+    def get(self, bucket):
+        slot = bucket % self.size
+        return self.values[slot] if self.buckets[slot] == bucket else 0
+
+class TrafficSeries:
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = resolutions
+        self.rings = {}
+        self.dirty = {}
+        self.lock = threading.Lock()
+
+    def _rings(self, username):
+        rings = self.rings.get(username)
+        if rings is None:
+            rings = {name: Ring(step, size) for name, (step, size) in self.resolutions.items()}
+            self.rings[username] = rings
+        return rings
+
+    def add(self, username, value, now):
+        if value <= 0:
+            return
+        with self.lock:
+            for name, ring in self._rings(username).items():
+                bucket = int(now) // ring.step
+                self.dirty[(username, name, bucket)] = ring.add(bucket, value)
+
+    def load(self, rows):
+        with self.lock:
+            for username, name, bucket, value in rows:
+                if name in self.resolutions:
+                    self._rings(username)[name].set(bucket, value)
+
+    def remove(self, username):
+        with self.lock:
+            self.rings.pop(username, None)
+            self.dirty = {key: value for key, value in self.dirty.items() if key[0] != username}
+
+    def take_dirty(self):
+        with self.lock:
+            rows = [(username, name, bucket, value) for (username, name, bucket), value in self.dirty.items()]
+            self.dirty = {}
+        return rows
+
+    def series(self, username, name, count, now):
+        step = self.resolutions[name][0]
+        last = int(now) // step
+        with self.lock:
+            ring = self.rings.get(username, {}).get(name)
+            return [
+                (bucket * step, ring.get(bucket) if ring else 0)
+                for bucket in range(last - count + 1, last + 1)
+            ]
+
+    def oldest_buckets(self, now):
+        return {
+            name: int(now) // step - size + 1
+            for name, (step, size) in self.resolutions.items()
+        }
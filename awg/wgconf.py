@@ -0,0 +1,170 @@
+import os
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+from collections import namedtuple
+
+PeerBlock = namedtuple('PeerBlock', [
+    'name', 'public_key', 'preshared_key', 'allowed_ips', 'blocked', 'start', 'end'
+])
+ConfigIndex = namedtuple('ConfigIndex', ['peers', 'keys', 'interface'])
+
+_indexes = {}
+_write_lock = threading.Lock()
+
+def _split_option(line):
+    if '=' not in line:
+        return None, None
+    key, value = line.split('=', 1)
+    return key.strip(), value.strip()
+
+def parse_config(data):
+    peers = {}
+    interface = {}
+    in_interface = False
+    current = None
+    offset = 0
+
+    for raw_line in data.splitlines(keepends=True):
+        line_start = offset
+        offset += len(raw_line)
+        line = raw_line.decode('utf-8', 'replace').strip()
+
+        if line.startswith('# BEGIN_PEER '):
+            in_interface = False
+            current = {
+                'name': line[len('# BEGIN_PEER '):].strip(),
+                'start': line_start,
+                'options': {},
+                'blocked': True
+            }
+            continue
+
+        if current is not None:
+            if line.startswith('# END_PEER ') and line[len('# END_PEER '):].strip() == current['name']:
+                options = current['options']
+                peers[current['name']] = PeerBlock(
+                    current['name'],
+                    options.get('PublicKey', ''),
+                    options.get('PresharedKey', ''),
+                    options.get('AllowedIPs', ''),
+                    current['blocked'],
+                    current['start'],
+                    offset
+                )
+                current = None
+                continue
+            if not line:
+                continue
+            if not line.startswith('#'):
+                current['blocked'] = False
+            key, value = _split_option(line.lstrip('# '))
+            if key and key not in current['options']:
+                current['options'][key] = value
+            continue
+
+        if line.startswith('['):
+            in_interface = line.startswith('[Interface]')
+            continue
+        if in_interface and line and not line.startswith('#'):
+            key, value = _split_option(line)
+            if not key:
+                continue
+            if key in interface and key in ('Address', 'DNS'):
+                interface[key] = f"{interface[key]}, {value}"
+            elif key not in interface:
+                interface[key] = value
+
+    keys = {peer.public_key: name for name, peer in peers.items() if peer.public_key}
+    return ConfigIndex(peers, keys, interface)
+
+def get_index(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ConfigIndex({}, {}, {})
+
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _indexes.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        index = parse_config(f.read())
+    _indexes[path] = (signature, index)
+    return index
+
+@contextmanager
+def locked(path):
+    with _write_lock:
+        with open(f'{path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def write_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            stat = os.stat(path)
+            os.chmod(temp_path, stat.st_mode & 0o7777)
+            os.chown(temp_path, stat.st_uid, stat.st_gid)
+        except OSError:
+            pass
+        os.replace(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def set_blocked(data, index, names, blocked):
+    spans = sorted((index.peers[name].start, index.peers[name].end) for name in names if name in index.peers)
+    parts = []
+    position = 0
+    for start, end in spans:
+        lines = data[start:end].splitlines(keepends=True)
+        body = lines[1:-1]
+        if blocked:
+            body = [line if line.strip().startswith(b'#') else b'# ' + line for line in body]
+        else:
+            body = [line.lstrip(b'# ').rstrip(b'\n') + b'\n' for line in body]
+        parts.append(data[position:start])
+        parts.append(lines[0])
+        parts.extend(body)
+        parts.append(lines[-1])
+        position = end
+    parts.append(data[position:])
+    return b''.join(parts)
+
+def update_config(path, transform):
+    with locked(path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+        cached = _indexes.get(path)
+        if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            index = cached[1]
+        else:
+            index = parse_config(data)
+            _indexes[path] = ((stat.st_mtime_ns, stat.st_size), index)
+        new_data = transform(data, index)
+        if new_data is None or new_data == data:
+            return index
+        write_atomic(path, new_data)
+        index = parse_config(new_data)
+        stat = os.stat(path)
+        _indexes[path] = ((stat.st_mtime_ns, stat.st_size), index)
+        return index
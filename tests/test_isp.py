@@ -0,0 +1,110 @@
+import asyncio
+import time
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import isp
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+async def start_stub(handler):
+    app = web.Application()
+    app.router.add_post('/batch', handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+def make_lookup(server, **kwargs):
+    return isp.IspLookup(url=str(server.make_url('/batch')), delay=0, **kwargs)
+
+def test_batches_and_coalesces_requests():
+    requests = []
+
+    async def handler(request):
+        ips = await request.json()
+        requests.append(ips)
+        return web.json_response([{'status': 'success', 'query': ip, 'isp': f'ISP {ip}'} for ip in ips])
+
+    async def main():
+        server = await start_stub(handler)
+        lookup = make_lookup(server, batch_size=3)
+        try:
+            ips = ['1.1.1.1', '2.2.2.2', '3.3.3.3', '4.4.4.4', '1.1.1.1']
+            results = await asyncio.gather(*(lookup.lookup(ip) for ip in ips))
+        finally:
+            await lookup.close()
+            await server.close()
+        return results
+
+    results = run(main())
+    assert results == ['ISP 1.1.1.1', 'ISP 2.2.2.2', 'ISP 3.3.3.3', 'ISP 4.4.4.4', 'ISP 1.1.1.1']
+    assert requests == [['1.1.1.1', '2.2.2.2', '3.3.3.3'], ['4.4.4.4']]
+
+def test_failed_lookups_resolve_to_none():
+    async def handler(request):
+        return web.json_response({'status': 'fail', 'message': 'invalid query'})
+
+    async def main():
+        server = await start_stub(handler)
+        lookup = make_lookup(server)
+        try:
+            first = await asyncio.wait_for(lookup.lookup('1.1.1.1'), 5)
+            second = await asyncio.wait_for(lookup.lookup('1.1.1.1'), 5)
+        finally:
+            await lookup.close()
+            await server.close()
+        return first, second, lookup.inflight
+
+    first, second, inflight = run(main())
+    assert first is None and second is None
+    assert inflight == {}
+
+def test_rate_limit_headers_delay_next_request():
+    times = []
+
+    async def handler(request):
+        ips = await request.json()
+        times.append(time.monotonic())
+        return web.json_response(
+            [{'status': 'success', 'query': ip, 'isp': 'ISP'} for ip in ips],
+            headers={'X-Rl': '0', 'X-Ttl': '1'}
+        )
+
+    async def main():
+        server = await start_stub(handler)
+        lookup = make_lookup(server)
+        try:
+            await lookup.lookup('1.1.1.1')
+            await lookup.lookup('2.2.2.2')
+        finally:
+            await lookup.close()
+            await server.close()
+
+    run(main())
+    assert len(times) == 2
+    assert times[1] - times[0] >= 0.9
+
+def test_token_bucket_limits_requests_per_period():
+    async def main():
+        bucket = isp.TokenBucket(2, 1)
+        start = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert run(main()) >= 0.4
+
+def test_unexpected_errors_do_not_leave_lookups_pending():
+    async def main():
+        lookup = isp.IspLookup(delay=0)
+
+        async def broken(ips):
+            raise RuntimeError('broken')
+
+        lookup._request = broken
+        result = await asyncio.wait_for(lookup.lookup('1.1.1.1'), 5)
+        return result, lookup.inflight
+
+    result, inflight = run(main())
+    assert result is None
+    assert inflight == {}